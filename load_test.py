@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+"""
+Load generator for the Music On Hold SIP server
+Holds many concurrent calls built with SimpleSIPClient, checks the RTP that comes back
+and reports setup rate, latency percentiles and server CPU/RSS per held call
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from test_sip_client import SimpleSIPClient
+
+CLOCK_RATE = 8000
+RTP_HEADER = struct.Struct('!BBHII')
+
+# RFC 3261 Timer A/E: retransmit at T1 doubling up to T2 until something comes back
+T1 = 0.5
+T2 = 4.0
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def parse_message(data):
+    """Split a SIP message into its start line and a dict of the headers we need"""
+    head, _, body = data.decode('utf-8', 'replace').partition('\r\n\r\n')
+    lines = head.split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers.setdefault(name.strip().lower(), value.strip())
+    return lines, headers, body
+
+
+def media_port(body):
+    """RTP port from the m=audio line of an SDP answer"""
+    for line in body.splitlines():
+        if line.startswith('m=audio '):
+            return int(line.split()[1])
+    return None
+
+
+class StreamStats:
+    """RFC 3550 receiver statistics for one incoming RTP stream"""
+
+    __slots__ = ('packets', 'base_seq', 'max_seq', 'cycles', 'gaps', 'reordered',
+                 'duplicates', 'transit', 'jitter', 'max_jitter')
+
+    def __init__(self):
+        self.packets = 0
+        self.base_seq = 0
+        self.max_seq = 0
+        self.cycles = 0
+        self.gaps = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.transit = None
+        self.jitter = 0.0
+        self.max_jitter = 0.0
+
+    def receive(self, sequence, timestamp, arrival):
+        """Account for one packet (appendix A.1 sequence tracking, A.8 jitter)"""
+        if self.packets == 0:
+            self.base_seq = self.max_seq = sequence
+        else:
+            delta = (sequence - self.max_seq) & 0xFFFF
+            if delta == 0:
+                self.duplicates += 1
+            elif delta < 0x8000:
+                if delta > 1:
+                    self.gaps += 1
+                if sequence < self.max_seq:
+                    self.cycles += 0x10000
+                self.max_seq = sequence
+            else:
+                self.reordered += 1
+        self.packets += 1
+
+        transit = arrival * CLOCK_RATE - timestamp
+        if self.transit is not None:
+            # Fold the 32-bit RTP timestamp wrap back into a small signed difference
+            d = abs((transit - self.transit + 2 ** 31) % 2 ** 32 - 2 ** 31)
+            self.jitter += (d - self.jitter) / 16
+            self.max_jitter = max(self.max_jitter, self.jitter)
+        self.transit = transit
+
+    @property
+    def expected(self):
+        return self.cycles + self.max_seq - self.base_seq + 1 if self.packets else 0
+
+    @property
+    def lost(self):
+        return max(0, self.expected - self.packets)
+
+
+class RTPReceiver(asyncio.DatagramProtocol):
+    """One socket for every call's media; streams are told apart by the server's RTP port"""
+
+    def __init__(self):
+        self.streams = {}
+        self.stray = 0
+
+    def datagram_received(self, data, addr):
+        stats = self.streams.get(addr[1])
+        if stats is None or len(data) < RTP_HEADER.size:
+            self.stray += 1
+            return
+        _, _, sequence, timestamp, _ = RTP_HEADER.unpack_from(data)
+        stats.receive(sequence, timestamp, time.perf_counter())
+
+
+class SIPEndpoint(asyncio.DatagramProtocol):
+    """Shared signalling socket; responses are matched to waiters by Call-ID and CSeq"""
+
+    def __init__(self):
+        self.transport = None
+        self.waiters = {}
+        self.server_byes = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        lines, headers, body = parse_message(data)
+        if not lines[0].startswith('SIP/2.0 '):
+            self.answer_request(lines, headers, addr)
+            return
+        key = (headers.get('call-id'), headers.get('cseq'))
+        waiter = self.waiters.get(key)
+        if waiter is None:
+            # Retransmitted 200 OK after we already ACKed, or a late reply to a timed-out request
+            return
+        code = int(lines[0].split()[1])
+        waiter['provisional'] = True
+        if code >= 200 and not waiter['future'].done():
+            waiter['future'].set_result((code, lines, body))
+
+    def answer_request(self, lines, headers, addr):
+        """200 OK for server-originated BYE (session timer expiry, max duration)"""
+        method = lines[0].split(' ', 1)[0]
+        if method == 'ACK':
+            return
+        if method == 'BYE':
+            self.server_byes += 1
+        response = [line for line in lines[1:]
+                    if line.split(':', 1)[0].lower() in ('via', 'from', 'to', 'call-id', 'cseq')]
+        message = 'SIP/2.0 200 OK\r\n' + '\r\n'.join(response) + '\r\nContent-Length: 0\r\n\r\n'
+        self.transport.sendto(message.encode(), addr)
+
+    async def request(self, message, call_id, cseq, addr, timeout):
+        """Send a request, retransmitting until a response arrives; None on timeout"""
+        key = (call_id, cseq)
+        waiter = {'future': asyncio.get_running_loop().create_future(), 'provisional': False}
+        self.waiters[key] = waiter
+        data = message.encode()
+        deadline = time.monotonic() + timeout
+        interval = T1
+        try:
+            while True:
+                if not waiter['provisional']:
+                    self.transport.sendto(data, addr)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    return await asyncio.wait_for(asyncio.shield(waiter['future']),
+                                                  min(interval, remaining))
+                except asyncio.TimeoutError:
+                    interval = min(interval * 2, T2)
+        finally:
+            del self.waiters[key]
+
+    def send(self, message, addr):
+        self.transport.sendto(message.encode(), addr)
+
+
+def process_tree(pid):
+    """The server pid plus any SO_REUSEPORT workers it forked"""
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def process_usage(pid):
+    """(CPU seconds, RSS bytes) summed over the server's process tree"""
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = 0.0
+    rss = 0
+    for member in process_tree(pid):
+        try:
+            with open(f'/proc/{member}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{member}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+        # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+    return cpu, rss
+
+
+class LoadTest:
+    """Ramp up concurrent held calls, measure the plateau, then hang them all up"""
+
+    def __init__(self, args):
+        self.args = args
+        self.server = (args.host, args.port)
+        self.sip = None
+        self.rtp = None
+        self.local_port = None
+        self.rtp_port = None
+        self.setup_times = []
+        self.failures = {}
+        self.held = 0
+        self.released = None
+        self.calls = []
+
+    def fail(self, reason):
+        self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    def new_client(self):
+        return SimpleSIPClient(self.args.host, self.args.port, self.local_port, self.args.local_ip)
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        _, self.sip = await loop.create_datagram_endpoint(
+            SIPEndpoint, local_addr=(self.args.local_ip, 0))
+        rtp_transport, self.rtp = await loop.create_datagram_endpoint(
+            RTPReceiver, local_addr=(self.args.local_ip, 0))
+        # Thousands of 50 pps streams land on one socket; give the kernel room to queue them
+        sock = rtp_transport.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+        self.local_port = self.sip.transport.get_extra_info('sockname')[1]
+        self.rtp_port = sock.getsockname()[1]
+
+    async def options_flood(self):
+        """Keep a window of OPTIONS outstanding for the configured duration"""
+        latencies = []
+        timeouts = 0
+        stop = time.perf_counter() + self.args.options_duration
+
+        async def worker():
+            nonlocal timeouts
+            client = self.new_client()
+            while time.perf_counter() < stop:
+                message = client.create_options()
+                call_id = message.split('Call-ID: ', 1)[1].split('\r\n', 1)[0]
+                started = time.perf_counter()
+                result = await self.sip.request(message, call_id, '1 OPTIONS', self.server,
+                                                self.args.timeout)
+                if result is None:
+                    timeouts += 1
+                else:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.args.options_window)))
+        elapsed = time.perf_counter() - started
+        return {
+            'options_per_second': len(latencies) / elapsed,
+            'options_p50_ms': percentile(latencies, 0.50) * 1000,
+            'options_p99_ms': percentile(latencies, 0.99) * 1000,
+            'options_timeouts': timeouts,
+        }
+
+    async def place_call(self):
+        """INVITE -> 200 -> ACK, hold until released, then BYE"""
+        client = self.new_client()
+        invite = client.create_invite(self.args.target, self.rtp_port)
+        started = time.perf_counter()
+        result = await self.sip.request(invite, client.call_id, '1 INVITE', self.server,
+                                        self.args.timeout)
+        if result is None:
+            self.fail('timeout')
+            return
+        code, lines, body = result
+        # ACK is sent for final responses of either kind; the server's transaction needs it
+        self.sip.send(client.create_ack(lines), self.server)
+        if code != 200:
+            self.fail(str(code))
+            return
+        self.setup_times.append(time.perf_counter() - started)
+
+        port = media_port(body)
+        stats = StreamStats()
+        if port is not None:
+            self.rtp.streams[port] = stats
+        self.calls.append(stats)
+        self.held += 1
+        await self.released.wait()
+
+        result = await self.sip.request(client.create_bye(lines), client.call_id, '2 BYE',
+                                        self.server, self.args.timeout)
+        self.held -= 1
+        self.rtp.streams.pop(port, None)
+        if result is None or result[0] != 200:
+            self.fail('bye ' + (str(result[0]) if result else 'timeout'))
+
+    async def run_calls(self):
+        """Offer calls at a fixed rate, hold the plateau, release, and summarise"""
+        args = self.args
+        self.released = asyncio.Event()
+        tasks = []
+        started = time.perf_counter()
+        for i in range(args.calls):
+            # Absolute schedule, so a slow event loop does not quietly lower the offered rate
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self.place_call()))
+
+        # Every INVITE has been sent; wait for the stragglers to be answered or fail
+        while self.held + sum(self.failures.values()) < args.calls:
+            await asyncio.sleep(0.05)
+        ramp = time.perf_counter() - started
+
+        usage_start = process_usage(args.server_pid) if args.server_pid else None
+        plateau = time.perf_counter()
+        held = self.held
+        print(f"{held} calls held, measuring for {args.hold:.0f}s")
+        await asyncio.sleep(args.hold)
+        usage_end = process_usage(args.server_pid) if args.server_pid else None
+        plateau = time.perf_counter() - plateau
+
+        self.released.set()
+        await asyncio.gather(*tasks)
+
+        results = {
+            'calls_offered': args.calls,
+            'calls_answered': len(self.setup_times),
+            'calls_per_second': len(self.setup_times) / ramp,
+            'setup_p50_ms': percentile(self.setup_times, 0.50) * 1000,
+            'setup_p90_ms': percentile(self.setup_times, 0.90) * 1000,
+            'setup_p99_ms': percentile(self.setup_times, 0.99) * 1000,
+            'setup_max_ms': max(self.setup_times, default=0.0) * 1000,
+            'failures': dict(self.failures),
+            'server_byes': self.sip.server_byes,
+        }
+        results.update(self.rtp_summary())
+        if usage_start and usage_end and held:
+            cpu = (usage_end[0] - usage_start[0]) / plateau
+            results['server_cpu_percent'] = cpu * 100
+            results['server_cpu_percent_per_call'] = cpu * 100 / held
+            results['server_rss_mb'] = usage_end[1] / 2 ** 20
+            results['server_rss_kb_per_call'] = (usage_end[1] - self.baseline_rss) / 1024 / held
+        return results
+
+    def rtp_summary(self):
+        streams = self.calls
+        expected = sum(s.expected for s in streams)
+        lost = sum(s.lost for s in streams)
+        jitter = [s.jitter / CLOCK_RATE * 1000 for s in streams if s.packets]
+        return {
+            'rtp_streams': len(streams),
+            'rtp_silent_streams': sum(1 for s in streams if not s.packets),
+            'rtp_packets': sum(s.packets for s in streams),
+            'rtp_loss_percent': lost / expected * 100 if expected else 0.0,
+            'rtp_streams_with_gaps': sum(1 for s in streams if s.gaps),
+            'rtp_reordered': sum(s.reordered for s in streams),
+            'rtp_jitter_mean_ms': sum(jitter) / len(jitter) if jitter else 0.0,
+            'rtp_jitter_p99_ms': percentile(jitter, 0.99),
+            'rtp_jitter_max_ms': max((s.max_jitter / CLOCK_RATE * 1000 for s in streams), default=0.0),
+            'rtp_stray_packets': self.rtp.stray,
+        }
+
+    async def run(self):
+        await self.open()
+        self.baseline_rss = process_usage(self.args.server_pid)[1] if self.args.server_pid else 0
+        results = {}
+        if self.args.options_duration > 0:
+            print(f"OPTIONS flood: {self.args.options_window} outstanding for "
+                  f"{self.args.options_duration:.0f}s")
+            results.update(await self.options_flood())
+        if self.args.calls > 0:
+            print(f"Calls: {self.args.calls} at {self.args.rate:g}/s")
+            results.update(await self.run_calls())
+        return results
+
+
+def spawn_server(args):
+    """Start a local server sized for the run; returns the Popen handle"""
+    # Two ports per call (RTP and the unused RTCP slot) plus headroom
+    port_end = args.spawn_rtp_start + args.calls * 2 + 100
+    code = (
+        "import sip_server\n"
+        f"sip_server.SimpleSIPServer(host={args.host!r}, port={args.port}, "
+        f"audio_file={args.spawn!r}, answer_delay=0, rtp_port_start={args.spawn_rtp_start}, "
+        f"rtp_port_end={port_end}, metrics_port=0, log_level='WARNING', "
+        f"workers={args.spawn_workers}).start_server()\n"
+    )
+    server = subprocess.Popen([sys.executable, '-c', code],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    # Audio is encoded and cached before the socket opens; give it time to come up
+    time.sleep(args.spawn_wait)
+    if server.poll() is not None:
+        raise SystemExit(f"server exited with status {server.returncode}")
+    return server
+
+
+def print_results(results, baseline=None):
+    print()
+    print(f"{'metric':<30} {'value':>12}" + (f" {'baseline':>12} {'change':>8}" if baseline else ''))
+    for name, value in results.items():
+        if isinstance(value, dict):
+            print(f"{name:<30} {json.dumps(value):>12}")
+            continue
+        line = f"{name:<30} {value:>12.3f}" if isinstance(value, float) else f"{name:<30} {value:>12}"
+        previous = baseline.get(name) if baseline else None
+        if isinstance(previous, (int, float)) and not isinstance(value, dict):
+            change = f"{(value - previous) / previous * 100:+.1f}%" if previous else '-'
+            line += f" {previous:>12.3f} {change:>8}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1', help='server address')
+    parser.add_argument('--port', type=int, default=5060, help='server SIP port')
+    parser.add_argument('--local-ip', default='127.0.0.1', help='address to bind and advertise')
+    parser.add_argument('--target', default='123', help='Request-URI user to call')
+    parser.add_argument('--calls', type=int, default=100, help='concurrent calls to hold')
+    parser.add_argument('--rate', type=float, default=50.0, help='new calls per second during ramp')
+    parser.add_argument('--hold', type=float, default=10.0, help='seconds to hold the plateau')
+    parser.add_argument('--timeout', type=float, default=32.0, help='transaction timeout (Timer B)')
+    parser.add_argument('--options-duration', type=float, default=0.0, help='seconds of OPTIONS flood')
+    parser.add_argument('--options-window', type=int, default=64, help='outstanding OPTIONS')
+    parser.add_argument('--server-pid', type=int, help='sample CPU/RSS of this process tree')
+    parser.add_argument('--spawn', metavar='WAV', help='start a local server playing WAV')
+    parser.add_argument('--spawn-workers', type=int, default=1, help='workers for --spawn')
+    parser.add_argument('--spawn-rtp-start', type=int, default=20000, help='RTP range for --spawn')
+    parser.add_argument('--spawn-wait', type=float, default=3.0, help='seconds to let --spawn start')
+    parser.add_argument('--save', metavar='JSON', help='write results for later comparison')
+    parser.add_argument('--baseline', metavar='JSON', help='compare against saved results')
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn:
+        server = spawn_server(args)
+        args.server_pid = server.pid
+
+    try:
+        results = asyncio.run(LoadTest(args).run())
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,269 +4,4101 @@ Lightweight SIP Server for Music On Hold
 Simple implementation that responds to SIP INVITE with automatic Music On Hold
 """
 
+import asyncio
+import bisect
+import hashlib
+import heapq
+import ipaddress
+import itertools
+import json
+import logging
+import logging.handlers
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import queue
+import signal
 import socket
+import ssl
+import struct
+import subprocess
+import sys
 import threading
 import time
 import random
-import subprocess
 import os
+import re
+import wave
+import warnings
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        import audioop
+    except ImportError:
+        # Removed from the standard library in Python 3.13
+        audioop = None
+
+SAMPLE_RATE = 8000
+FRAME_SAMPLES = 160       # 20 ms at 8 kHz; also the payload size of every supported codec
+FRAME_INTERVAL = 0.02
+PAYLOAD_TYPE_PCMU = 0
+PAYLOAD_TYPE_PCMA = 8
+PAYLOAD_TYPE_G722 = 9
+# New tracks are playable once this much is encoded; the rest is encoded in the background
+INGEST_PREFIX_SECONDS = 3
+# Audio decoded and encoded per background step, so tracks being ingested take turns
+INGEST_CHUNK_SECONDS = 1
+
+
+def _linear_to_ulaw(sample):
+    """Encode one signed 16-bit sample as G.711 mu-law (CCITT reference rounding)"""
+    sample >>= 2
+    if sample < 0:
+        sample = -sample
+        mask = 0x7F
+    else:
+        mask = 0xFF
+    sample = min(sample, 8159) + 0x21
+    segment = (sample >> 6).bit_length()
+    if segment > 7:
+        return 0x7F ^ mask
+    return ((segment << 4) | ((sample >> (segment + 1)) & 0x0F)) ^ mask
+
+
+# Lookup table indexed by the unsigned 16-bit representation of a sample
+_ULAW_TABLE = bytes(_linear_to_ulaw(u - 0x10000 if u & 0x8000 else u) for u in range(0x10000))
+
+
+def encode_pcmu(pcm):
+    """Encode little-endian signed 16-bit PCM to mu-law bytes"""
+    if audioop:
+        return audioop.lin2ulaw(pcm, 2)
+    samples = array('H', pcm)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return bytes(map(_ULAW_TABLE.__getitem__, samples))
+
+
+# Largest 13-bit magnitude in each A-law segment
+_ALAW_SEGMENT_ENDS = (0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF)
+
+
+def _linear_to_alaw(sample):
+    """Encode one signed 16-bit sample as G.711 A-law (CCITT reference rounding)"""
+    sample >>= 3
+    if sample >= 0:
+        mask = 0xD5
+    else:
+        mask = 0x55
+        sample = -sample - 1
+    segment = 0
+    while segment < 8 and sample > _ALAW_SEGMENT_ENDS[segment]:
+        segment += 1
+    if segment > 7:
+        return 0x7F ^ mask
+    shift = 1 if segment < 2 else segment
+    return ((segment << 4) | ((sample >> shift) & 0x0F)) ^ mask
+
+
+_ALAW_TABLE = bytes(_linear_to_alaw(u - 0x10000 if u & 0x8000 else u) for u in range(0x10000))
+
+
+def encode_pcma(pcm):
+    """Encode little-endian signed 16-bit PCM to A-law bytes"""
+    if audioop:
+        return audioop.lin2alaw(pcm, 2)
+    samples = array('H', pcm)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return bytes(map(_ALAW_TABLE.__getitem__, samples))
+
+
+def _saturate(amp):
+    if amp > 32767:
+        return 32767
+    if amp < -32768:
+        return -32768
+    return amp
+
+
+# ITU-T G.722 tables (64 kbit/s mode)
+_Q6 = (0, 35, 72, 110, 150, 190, 233, 276, 323, 370, 422, 473, 530, 587, 650, 714,
+       786, 858, 940, 1023, 1121, 1219, 1339, 1458, 1612, 1765, 1980, 2195, 2557, 2919, 0, 0)
+_ILN = (0, 63, 62, 31, 30, 29, 28, 27, 26, 25, 24, 23, 22, 21, 20, 19,
+        18, 17, 16, 15, 14, 13, 12, 11, 10, 9, 8, 7, 6, 5, 4, 0)
+_ILP = (0, 61, 60, 59, 58, 57, 56, 55, 54, 53, 52, 51, 50, 49, 48, 47,
+        46, 45, 44, 43, 42, 41, 40, 39, 38, 37, 36, 35, 34, 33, 32, 0)
+_WL = (-60, -30, 58, 172, 334, 538, 1198, 3042)
+_RL42 = (0, 7, 6, 5, 4, 3, 2, 1, 7, 6, 5, 4, 3, 2, 1, 0)
+_ILB = (2048, 2093, 2139, 2186, 2233, 2282, 2332, 2383, 2435, 2489, 2543, 2599, 2656, 2714, 2774, 2834,
+        2896, 2960, 3025, 3091, 3158, 3228, 3298, 3371, 3444, 3520, 3597, 3676, 3756, 3838, 3922, 4008)
+_QM4 = (0, -20456, -12896, -8968, -6288, -4240, -2584, -1200, 20456, 12896, 8968, 6288, 4240, 2584, 1200, 0)
+_QM2 = (-7408, -1616, 7408, 1616)
+_QMF_COEFFS = (3, -11, 12, 32, -210, 951, 3876, -805, 362, -156, 53, -11)
+_IHN = (0, 1, 0)
+_IHP = (0, 3, 2)
+_WH = (0, -214, 798)
+_RH2 = (2, 1, 2, 1)
+
+
+class _G722Band:
+    """Adaptive predictor state of one G.722 sub-band"""
+
+    def __init__(self, det):
+        self.s = 0
+        self.sp = 0
+        self.sz = 0
+        self.r = [0, 0, 0]
+        self.a = [0, 0, 0]
+        self.ap = [0, 0, 0]
+        self.p = [0, 0, 0]
+        self.d = [0] * 7
+        self.b = [0] * 7
+        self.bp = [0] * 7
+        self.nb = 0
+        self.det = det
+
+    def update(self, d):
+        """Blocks 4L/4H: reconstruct, adapt the pole/zero predictor and predict the next sample"""
+        r, a, ap, p, dd, b, bp = self.r, self.a, self.ap, self.p, self.d, self.b, self.bp
+        dd[0] = d
+        r[0] = _saturate(self.s + d)
+        p[0] = _saturate(self.sz + d)
+
+        # UPPOL2
+        sg0 = p[0] >> 15
+        sg1 = p[1] >> 15
+        sg2 = p[2] >> 15
+        wd1 = _saturate(a[1] << 2)
+        wd2 = -wd1 if sg0 == sg1 else wd1
+        if wd2 > 32767:
+            wd2 = 32767
+        wd3 = (wd2 >> 7) + (128 if sg0 == sg2 else -128)
+        wd3 += (a[2] * 32512) >> 15
+        ap[2] = max(-12288, min(12288, wd3))
+
+        # UPPOL1
+        wd1 = 192 if sg0 == sg1 else -192
+        wd2 = (a[1] * 32640) >> 15
+        ap[1] = _saturate(wd1 + wd2)
+        wd3 = _saturate(15360 - ap[2])
+        if ap[1] > wd3:
+            ap[1] = wd3
+        elif ap[1] < -wd3:
+            ap[1] = -wd3
+
+        # UPZERO
+        wd1 = 0 if d == 0 else 128
+        sg0 = d >> 15
+        for i in range(1, 7):
+            wd2 = wd1 if (dd[i] >> 15) == sg0 else -wd1
+            bp[i] = _saturate(wd2 + ((b[i] * 32640) >> 15))
+
+        # DELAYA
+        for i in range(6, 0, -1):
+            dd[i] = dd[i - 1]
+            b[i] = bp[i]
+        for i in (2, 1):
+            r[i] = r[i - 1]
+            p[i] = p[i - 1]
+            a[i] = ap[i]
+
+        # FILTEP
+        wd1 = (a[1] * _saturate(r[1] + r[1])) >> 15
+        wd2 = (a[2] * _saturate(r[2] + r[2])) >> 15
+        self.sp = _saturate(wd1 + wd2)
+
+        # FILTEZ
+        sz = 0
+        for i in range(6, 0, -1):
+            sz += (b[i] * _saturate(dd[i] + dd[i])) >> 15
+        self.sz = _saturate(sz)
+
+        # PREDIC
+        self.s = _saturate(self.sp + self.sz)
+
+
+class G722Encoder:
+    """ITU-T G.722 sub-band ADPCM encoder, 64 kbit/s mode (16 kHz PCM in, one byte per two samples)"""
+
+    def __init__(self):
+        self.x = [0] * 24
+        self.low = _G722Band(32)
+        self.high = _G722Band(8)
+
+    def encode(self, samples):
+        """Encode a sequence of signed 16-bit samples at 16 kHz (even length)"""
+        x = self.x
+        low = self.low
+        high = self.high
+        out = bytearray(len(samples) // 2)
+        for j in range(len(out)):
+            # Transmit QMF: split into low and high bands, decimated to 8 kHz
+            del x[:2]
+            x.append(samples[2 * j])
+            x.append(samples[2 * j + 1])
+            sumodd = 0
+            sumeven = 0
+            for i in range(12):
+                sumodd += x[2 * i] * _QMF_COEFFS[i]
+                sumeven += x[2 * i + 1] * _QMF_COEFFS[11 - i]
+            xlow = (sumeven + sumodd) >> 14
+            xhigh = (sumeven - sumodd) >> 14
+
+            # Low band: 6-bit adaptive quantiser
+            el = _saturate(xlow - low.s)
+            wd = el if el >= 0 else -(el + 1)
+            det = low.det
+            i = 1
+            while i < 30 and wd >= (_Q6[i] * det) >> 12:
+                i += 1
+            ilow = _ILN[i] if el < 0 else _ILP[i]
+            ril = ilow >> 2
+            dlow = (det * _QM4[ril]) >> 15
+            nb = ((low.nb * 127) >> 7) + _WL[_RL42[ril]]
+            low.nb = nb = max(0, min(18432, nb))
+            wd2 = 8 - (nb >> 11)
+            wd3 = _ILB[(nb >> 6) & 31]
+            low.det = (wd3 << -wd2 if wd2 < 0 else wd3 >> wd2) << 2
+            low.update(dlow)
+
+            # High band: 2-bit adaptive quantiser
+            eh = _saturate(xhigh - high.s)
+            wd = eh if eh >= 0 else -(eh + 1)
+            mih = 2 if wd >= (564 * high.det) >> 12 else 1
+            ihigh = _IHN[mih] if eh < 0 else _IHP[mih]
+            dhigh = (high.det * _QM2[ihigh]) >> 15
+            nb = ((high.nb * 127) >> 7) + _WH[_RH2[ihigh]]
+            high.nb = nb = max(0, min(22528, nb))
+            wd2 = 10 - (nb >> 11)
+            wd3 = _ILB[(nb >> 6) & 31]
+            high.det = (wd3 << -wd2 if wd2 < 0 else wd3 >> wd2) << 2
+            high.update(dhigh)
+
+            out[j] = (ihigh << 6) | ilow
+        return bytes(out)
+
+
+def g722_encoder():
+    """Encode function that keeps G.722 state across consecutive chunks of one track"""
+    encoder = G722Encoder()
+
+    def encode(pcm):
+        samples = array('h', pcm)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        return encoder.encode(samples)
+    return encode
+
+
+def encode_g722(pcm):
+    """Encode little-endian signed 16-bit PCM at 16 kHz to G.722 (pure Python, slow; encode once)"""
+    return g722_encoder()(pcm)
+
+
+class Codec:
+    """An encoding we can send: static RTP payload type, encoder input rate and encoder"""
+
+    def __init__(self, name, payload_type, input_rate, encode, encoder=None):
+        self.name = name
+        self.payload_type = payload_type
+        self.input_rate = input_rate
+        self.encode = encode
+        # Factory for stateful codecs whose output depends on the samples before a chunk
+        self._encoder = encoder
+        # PCM samples per 20 ms frame; every codec here turns them into FRAME_SAMPLES bytes
+        self.frame_input = int(input_rate * FRAME_INTERVAL)
+
+    def encoder(self):
+        """Encode function for one track delivered in consecutive chunks of whole frames"""
+        return self._encoder() if self._encoder else self.encode
+
+
+# G.722 is sampled at 16 kHz but, per RFC 3551, its RTP clock runs at 8 kHz
+CODECS = {codec.name: codec for codec in (
+    Codec('PCMU', PAYLOAD_TYPE_PCMU, 8000, encode_pcmu),
+    Codec('PCMA', PAYLOAD_TYPE_PCMA, 8000, encode_pcma),
+    Codec('G722', PAYLOAD_TYPE_G722, 16000, encode_g722, g722_encoder),
+)}
+
+
+def _to_mono_s16(pcm, sampwidth, channels):
+    """Convert raw WAV frames to mono signed 16-bit PCM"""
+    if audioop:
+        if sampwidth == 1:
+            pcm = audioop.bias(pcm, 1, -128)
+        if sampwidth != 2:
+            pcm = audioop.lin2lin(pcm, sampwidth, 2)
+        if channels == 2:
+            pcm = audioop.tomono(pcm, 2, 0.5, 0.5)
+        elif channels != 1:
+            raise ValueError(f"Unsupported channel count: {channels}")
+        return pcm
+
+    if sampwidth != 2:
+        raise ValueError(f"Unsupported sample width without audioop: {sampwidth}")
+    samples = array('h', pcm)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    if channels > 1:
+        samples = array('h', (sum(samples[i:i + channels]) // channels
+                              for i in range(0, len(samples), channels)))
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def _resample_s16(pcm, src_rate, dst_rate):
+    """Resample mono signed 16-bit PCM by linear interpolation"""
+    return Resampler(src_rate, dst_rate).convert(pcm)
+
+
+class Resampler:
+    """Linear-interpolation resampler for mono signed 16-bit PCM that arrives in consecutive chunks"""
+
+    def __init__(self, src_rate, dst_rate):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self._state = None
+        # Pure-Python state: last sample of the previous chunk and the next output position after
+        # it, in units of 1/dst_rate input samples so chunk boundaries add no rounding
+        self._last = None
+        self._position = 0
+
+    def convert(self, pcm):
+        if self.src_rate == self.dst_rate:
+            return pcm
+        if audioop:
+            pcm, self._state = audioop.ratecv(pcm, 2, 1, self.src_rate, self.dst_rate, self._state)
+            return pcm
+
+        samples = array('h', pcm)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        if self._last is not None:
+            samples.insert(0, self._last)
+        if not samples:
+            return b''
+        src_rate, dst_rate = self.src_rate, self.dst_rate
+        end = (len(samples) - 1) * dst_rate
+        out = array('h')
+        pos = self._position
+        while pos < end:
+            idx, frac = divmod(pos, dst_rate)
+            sample = samples[idx]
+            delta = (samples[idx + 1] - sample) * frac
+            # Truncate toward zero, as int() of the interpolated value would
+            out.append(sample + (delta // dst_rate if delta >= 0 else -(-delta // dst_rate)))
+            pos += src_rate
+        self._last = samples[-1]
+        self._position = pos - end
+        if sys.byteorder == 'big':
+            out.byteswap()
+        return out.tobytes()
+
+
+def _ffmpeg_pcm(path, rate, chunk_bytes):
+    """Decode any format ffmpeg understands to mono signed 16-bit PCM, streamed through a pipe"""
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-i', path,
+               '-f', 's16le', '-ac', '1', '-ar', str(rate), '-']
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RuntimeError("ffmpeg is not installed; only WAV files can be read without it")
+    try:
+        for chunk in iter(lambda: process.stdout.read(chunk_bytes), b''):
+            yield chunk
+        error = process.stderr.read().decode(errors='replace').strip()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg could not decode the file: {error}")
+    finally:
+        # Also reached when the consumer stops early, e.g. on shutdown
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def read_pcm(path, rate, chunk_seconds=INGEST_CHUNK_SECONDS):
+    """Yield an audio file as mono signed 16-bit PCM at rate, about chunk_seconds at a time
+
+    WAV is read in pure Python; anything else (MP3, ...) is piped through ffmpeg.
+    """
+    try:
+        wav = wave.open(path, 'rb')
+    except (wave.Error, EOFError):
+        yield from _ffmpeg_pcm(path, rate, int(rate * chunk_seconds) * 2)
+        return
+    with wav:
+        sampwidth = wav.getsampwidth()
+        channels = wav.getnchannels()
+        resampler = Resampler(wav.getframerate(), rate)
+        chunk_frames = max(1, int(wav.getframerate() * chunk_seconds))
+        for pcm in iter(lambda: wav.readframes(chunk_frames), b''):
+            yield resampler.convert(_to_mono_s16(pcm, sampwidth, channels))
+
+
+def encode_stream(path, encoding='PCMU', chunk_seconds=INGEST_CHUNK_SECONDS):
+    """Yield an audio file encoded with a codec from CODECS in chunks of whole 20 ms frames
+
+    The last frame is padded with silence so every packet is 20 ms.
+    """
+    codec = CODECS[encoding]
+    encode = codec.encoder()
+    frame_bytes = codec.frame_input * 2
+    pending = b''
+    for pcm in read_pcm(path, codec.input_rate, chunk_seconds):
+        pending += pcm
+        usable = len(pending) - len(pending) % frame_bytes
+        if usable:
+            yield encode(pending[:usable])
+            pending = pending[usable:]
+    if pending:
+        yield encode(pending + b'\x00' * (frame_bytes - len(pending)))
+
+
+def encode_wav(path, encoding='PCMU'):
+    """Read a whole audio file and encode it with a codec from CODECS"""
+    return b''.join(encode_stream(path, encoding))
+
+
+class EncodedFrames:
+    """Read-only sequence of 20 ms payloads sliced out of one shared buffer"""
+
+    complete = True
+
+    def __init__(self, buffer, offset=0):
+        # Keep the owner alive (bytes or mmap) for as long as the view exists
+        self._buffer = buffer
+        self._view = memoryview(buffer)[offset:]
+        self._count = len(self._view) // FRAME_SAMPLES
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        start = index * FRAME_SAMPLES
+        return self._view[start:start + FRAME_SAMPLES]
+
+
+# On-disk frame cache: header followed by the raw 160-byte payloads back to back
+CACHE_MAGIC = b'MOHF'
+CACHE_VERSION = 1
+# One cache file per track and codec: <sha256>.pcmu, <sha256>.pcma, <sha256>.g722
+CACHE_SUFFIXES = tuple('.' + name.lower() for name in CODECS)
+_CACHE_HEADER = struct.Struct('!4sHHI')
+
+
+def file_digest(path):
+    """SHA-256 of a file's contents, used as the frame cache key"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def open_frame_cache(cache_path):
+    """Memory-map a cache file, returning None if it is missing or invalid"""
+    try:
+        with open(cache_path, 'rb') as f:
+            header = f.read(_CACHE_HEADER.size)
+            if len(header) != _CACHE_HEADER.size:
+                return None
+            magic, version, frame_size, count = _CACHE_HEADER.unpack(header)
+            if (magic, version, frame_size) != (CACHE_MAGIC, CACHE_VERSION, FRAME_SAMPLES):
+                return None
+            if os.fstat(f.fileno()).st_size != _CACHE_HEADER.size + count * FRAME_SAMPLES:
+                return None
+            if count == 0:
+                return EncodedFrames(b'')
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+    return EncodedFrames(mapped, _CACHE_HEADER.size)
+
+
+def frame_cache_path(source, cache_dir, encoding='PCMU', digest=None):
+    """Content-addressed cache file for a source and codec, so identical tracks share one entry"""
+    return os.path.join(cache_dir, (digest or file_digest(source)) + '.' + encoding.lower())
+
+
+def _writer_alive(tmp_name):
+    """Whether the process named in a <cache>.<pid>.tmp file name is still running"""
+    try:
+        os.kill(int(tmp_name.rsplit('.', 2)[-2]), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def prune_frame_cache(cache_dir, keep):
+    """Remove cache files of tracks that are no longer configured"""
+    try:
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if name.endswith(CACHE_SUFFIXES) and path not in keep:
+                os.remove(path)
+            elif name.endswith('.tmp') and not _writer_alive(name):
+                # Left behind by a process killed in the middle of an ingest
+                os.remove(path)
+    except OSError:
+        pass
+
+
+class IngestFrames:
+    """Frames of a track that is still being encoded; grows at the end until complete"""
+
+    def __init__(self):
+        self.complete = False
+        self._count = 0
+        # (chunk start indexes, chunks) while in memory; the mapped cache file once written
+        self._chunks = ([], [])
+        self._frames = None
+
+    def append(self, encoded):
+        starts, chunks = self._chunks
+        starts.append(self._count)
+        chunks.append(encoded)
+        # Published last, so readers on the media thread never index past a stored chunk
+        self._count += len(encoded) // FRAME_SAMPLES
+
+    def finish(self, frames=None):
+        """Mark the track complete, switching to the cache file's frames if it was written"""
+        if frames is not None and len(frames) == self._count:
+            self._frames = frames
+            self._chunks = None
+        self.complete = True
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        chunks = self._chunks
+        if chunks is None:
+            return self._frames[index]
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        starts, chunks = chunks
+        chunk = bisect.bisect_right(starts, index) - 1
+        start = (index - starts[chunk]) * FRAME_SAMPLES
+        return memoryview(chunks[chunk])[start:start + FRAME_SAMPLES]
+
+
+class TrackIngest:
+    """Encodes one track in one codec chunk by chunk into IngestFrames and its cache file"""
+
+    def __init__(self, source, cache_path, encoding='PCMU'):
+        self.source = source
+        self.cache_path = cache_path
+        self.encoding = encoding
+        self.frames = IngestFrames()
+        self.started = time.monotonic()
+        self._chunks = encode_stream(source, encoding)
+        self._tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            self._file = open(self._tmp_path, 'wb')
+            # Frame count is filled in once the track is complete
+            self._file.write(_CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, FRAME_SAMPLES, 0))
+        except OSError:
+            # Read-only or full filesystem: keep serving from memory
+            self._file = None
+
+    def step(self):
+        """Encode the next chunk; returns False once the whole track is encoded"""
+        encoded = next(self._chunks, None)
+        if encoded is None:
+            self._finish()
+            return False
+        self.frames.append(encoded)
+        if self._file:
+            try:
+                self._file.write(encoded)
+            except OSError:
+                self._discard()
+        return True
+
+    def prefix(self, seconds):
+        """Encode at least the first seconds of the track; returns False if that was all of it"""
+        while len(self.frames) < seconds / FRAME_INTERVAL:
+            if not self.step():
+                return False
+        return True
+
+    def abort(self):
+        """Stop after an error, keeping what was encoded but leaving no cache file behind"""
+        self._chunks.close()
+        self._discard()
+        self.frames.finish()
+
+    def _finish(self):
+        frames = None
+        if self._file:
+            try:
+                self._file.seek(0)
+                self._file.write(_CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, FRAME_SAMPLES,
+                                                    len(self.frames)))
+                self._file.close()
+                self._file = None
+                os.replace(self._tmp_path, self.cache_path)
+                frames = open_frame_cache(self.cache_path)
+            except OSError:
+                self._discard()
+        # Serve from the page cache from now on and let the encoded chunks go
+        self.frames.finish(frames)
+
+    def _discard(self):
+        if self._file:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class Playlist:
+    """Tracks played back to back as one looping frame sequence, without gaps between tracks
+
+    While a track is still being encoded the playlist ends with it and grows with
+    it; later tracks join once it is complete, so positions already played never move.
+    """
+
+    def __init__(self, tracks, key=None):
+        self.tracks = [track for track in tracks if len(track) or not track.complete]
+        # Identifies the audio, so a reload can tell whether the playlist changed
+        self.key = key
+        self._growing = True
+        self._index()
+
+    def _index(self):
+        offsets = []
+        total = 0
+        growing = False
+        for track in self.tracks:
+            offsets.append(total)
+            total += len(track)
+            if not track.complete:
+                growing = True
+                break
+        self._offsets, self._length, self._growing = offsets, total, growing
+
+    def __len__(self):
+        if self._growing:
+            self._index()
+        return self._length
+
+    @property
+    def complete(self):
+        """False while a track it ends with is still being encoded"""
+        if self._growing:
+            self._index()
+        return not self._growing
+
+    def __getitem__(self, index):
+        track = bisect.bisect_right(self._offsets, index) - 1
+        return self.tracks[track][index - self._offsets[track]]
+
+
+class FrameCache:
+    """Encoded tracks shared by every playlist, evicted least-recently-used beyond max_bytes
+
+    Entries are keyed by the content-addressed cache file, so a track used by
+    several queues is decoded, encoded and held only once per codec. Eviction drops the
+    cache's reference; playlists that are still playing keep theirs. A track without a
+    cache file is returned as soon as its first seconds are encoded; one background
+    thread encodes the rest of every such track a chunk at a time.
+    """
+
+    def __init__(self, cache_dir, max_bytes=64 << 20, log=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.log = log or (lambda message, level=logging.INFO: None)
+        self._entries = OrderedDict()
+        # (source, mtime, size) -> digest, so lookups do not re-hash the source
+        self._digests = {}
+        self._lock = threading.Lock()
+        # Held while a track's first seconds are encoded, so each track is ingested once
+        self._ingest_lock = threading.Lock()
+        self._ingests = deque()
+        self._ingest_thread = None
+        # Tracks queued or being encoded by the background thread
+        self.ingesting = 0
+        # CPU seconds spent hashing and encoding tracks in any thread (the background
+        # thread, or the executor during a reload), which admission control leaves out
+        self.ingest_cpu = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def cache_path(self, source, encoding='PCMU'):
+        stat = os.stat(source)
+        key = (source, stat.st_mtime_ns, stat.st_size)
+        digest = self._digests.get(key)
+        if digest is None:
+            started = time.thread_time()
+            digest = self._digests[key] = file_digest(source)
+            self._count_cpu(started)
+        return frame_cache_path(source, self.cache_dir, encoding, digest)
+
+    def get(self, source, encoding='PCMU'):
+        """Return (frames, cache_hit) for a source, encoding it only if no cache exists anywhere"""
+        cache_path = self.cache_path(source, encoding)
+        with self._lock:
+            frames = self._entries.get(cache_path)
+            if frames is not None:
+                self._entries.move_to_end(cache_path)
+                self.hits += 1
+                return frames, True
+        with self._ingest_lock:
+            frames = self._entries.get(cache_path)
+            if frames is None:
+                frames = open_frame_cache(cache_path)
+            cache_hit = frames is not None
+            if not cache_hit:
+                started = time.thread_time()
+                try:
+                    frames = self.ingest(source, cache_path, encoding)
+                finally:
+                    self._count_cpu(started)
+            with self._lock:
+                self.misses += 1
+                self._entries[cache_path] = frames
+                self._evict()
+        return frames, cache_hit
+
+    def _count_cpu(self, started):
+        with self._lock:
+            self.ingest_cpu += time.thread_time() - started
+
+    def ingest(self, source, cache_path, encoding='PCMU'):
+        """Encode the first seconds of a track now and queue the rest for the background thread"""
+        ingest = TrackIngest(source, cache_path, encoding)
+        try:
+            growing = ingest.prefix(INGEST_PREFIX_SECONDS)
+        except Exception:
+            ingest.abort()
+            raise
+        if growing:
+            with self._lock:
+                self._ingests.append(ingest)
+                self.ingesting += 1
+                if self._ingest_thread is None:
+                    self._ingest_thread = threading.Thread(target=self._run_ingests, name='moh-ingest',
+                                                           daemon=True)
+                    self._ingest_thread.start()
+        return ingest.frames
+
+    def _run_ingests(self):
+        # Round-robin, one chunk at a time, so every new track stays ahead of its listeners
+        while True:
+            with self._lock:
+                if not self._ingests:
+                    self._ingest_thread = None
+                    return
+                ingest = self._ingests.popleft()
+            started = time.thread_time()
+            try:
+                growing = ingest.step()
+            except Exception as e:
+                ingest.abort()
+                with self._lock:
+                    self.ingesting -= 1
+                    # Not cached, so the next reload tries the whole track again
+                    if self._entries.get(ingest.cache_path) is ingest.frames:
+                        del self._entries[ingest.cache_path]
+                self.log(f"Error encoding {ingest.source} as {ingest.encoding}, playing only the first "
+                         f"{len(ingest.frames) * FRAME_INTERVAL:.1f}s: {e}", logging.ERROR)
+                continue
+            finally:
+                self._count_cpu(started)
+            if growing:
+                with self._lock:
+                    self._ingests.append(ingest)
+            else:
+                with self._lock:
+                    self.ingesting -= 1
+                frames = ingest.frames
+                self.log(f"Encoded {len(frames)} {ingest.encoding} frames ({len(frames) * FRAME_INTERVAL:.1f}s) "
+                         f"for {ingest.source} in {time.monotonic() - ingest.started:.2f}s")
+
+    def _evict(self):
+        total = sum(len(frames) for frames in self._entries.values()) * FRAME_SAMPLES
+        for cache_path, frames in list(self._entries.items()):
+            if total <= self.max_bytes or len(self._entries) <= 1:
+                break
+            if not frames.complete:
+                # Still being encoded: without its entry the next get() would ingest it again
+                continue
+            del self._entries[cache_path]
+            total -= len(frames) * FRAME_SAMPLES
+
+
+_RTP_HEADER = struct.Struct('!BBHII')
+
+
+class RTPStream:
+    """Per-call RTP header state for an outgoing stream in any codec"""
+
+    # ICMP port-unreachable reports before the peer is declared gone; the kernel
+    # surfaces one error per ICMP, so at most every other send fails (~1 s of audio)
+    UNREACHABLE_LIMIT = 25
+    # A gap this long (seconds) between reports starts the count again, so scattered
+    # reports over a long call (a phone briefly re-binding its port) never add up
+    UNREACHABLE_WINDOW = 1.0
+
+    def __init__(self, target, local_addr, payload_type=PAYLOAD_TYPE_PCMU, on_unreachable=None):
+        self.target = target
+        self.payload_type = payload_type
+        self.on_unreachable = on_unreachable
+        self.ssrc = random.getrandbits(32)
+        self.sequence = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+        self.marker = True
+        self.packets_sent = 0
+        self.refused = 0
+        self.refused_at = 0.0
+        self.sock = socket.socket(address_family(target[0]), socket.SOCK_DGRAM)
+        try:
+            self.sock.bind(local_addr)
+            # A connected socket reports ICMP port unreachable as ECONNREFUSED
+            self.sock.connect(target)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def set_target(self, target):
+        """Redirect the stream, e.g. after a re-INVITE with a new media address"""
+        if target != self.target:
+            self.sock.connect(target)
+            self.target = target
+            self.refused = 0
+
+    def build_packet(self, payload):
+        """Prefix a payload with this stream's RTP header"""
+        header = _RTP_HEADER.pack(
+            0x80,
+            (0x80 if self.marker else 0) | self.payload_type,
+            self.sequence,
+            self.timestamp,
+            self.ssrc,
+        )
+        self.marker = False
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.timestamp = (self.timestamp + FRAME_SAMPLES) & 0xFFFFFFFF
+        return header + payload
+
+    def skip(self, frames):
+        """Account for frames that were never sent: the RTP clock keeps running, sequence does not"""
+        self.timestamp = (self.timestamp + frames * FRAME_SAMPLES) & 0xFFFFFFFF
+        # Marker lets the receiver's jitter buffer resynchronise on the gap
+        self.marker = True
+
+    def send(self, payload):
+        try:
+            self.sock.send(self.build_packet(payload))
+            self.packets_sent += 1
+        except ConnectionRefusedError:
+            now = time.monotonic()
+            if now - self.refused_at > self.UNREACHABLE_WINDOW:
+                self.refused = 0
+            self.refused_at = now
+            self.refused += 1
+            if self.refused == self.UNREACHABLE_LIMIT and self.on_unreachable:
+                self.on_unreachable(self)
+        except OSError:
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+# RTCP packet types (RFC 3550 section 12.1)
+RTCP_SR = 200
+RTCP_RR = 201
+RTCP_SDES = 202
+RTCP_BYE = 203
+# Minimum interval between our Sender Reports; each one is randomised to 0.5-1.5x
+RTCP_INTERVAL = 5.0
+# Seconds between 1900 (NTP epoch) and 1970 (Unix epoch)
+NTP_EPOCH_OFFSET = 2208988800
+_RTCP_HEADER = struct.Struct('!BBH')
+_RTCP_SR = struct.Struct('!BBHIIIIII')
+_RTCP_REPORT_BLOCK = struct.Struct('!IIIIII')
+
+
+class RTCPSession:
+    """RTCP for one call's stream: our Sender Reports out, the phone's reception reports in
+
+    The socket sits on the RTP port + 1 and is only touched from the event
+    loop; the media thread never sees it. Reception statistics are the
+    latest report block the phone sent about our SSRC.
+    """
+
+    def __init__(self, stream, local_addr, target, cname):
+        self.stream = stream
+        self.target = target
+        cname = cname.encode()[:255]
+        chunk = struct.pack('!IBB', stream.ssrc, 1, len(cname)) + cname
+        # Item list ends with at least one null octet, padded to a 32-bit boundary
+        chunk += b'\0' * (4 - len(chunk) % 4)
+        self.sdes = _RTCP_HEADER.pack(0x81, RTCP_SDES, len(chunk) // 4) + chunk
+        self.next_report = time.monotonic() + random.uniform(0.5, 1.5) * RTCP_INTERVAL / 2
+        self.last_received = None
+        self.reports = 0
+        self.fraction_lost = 0.0
+        self.cumulative_lost = 0
+        self.highest_sequence = None
+        self.jitter = 0.0
+        self.rtt = None
+        self.sock = socket.socket(address_family(target[0]), socket.SOCK_DGRAM)
+        try:
+            self.sock.setblocking(False)
+            self.sock.bind(local_addr)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def sender_report(self, now):
+        """Compound SR + SDES CNAME for wall-clock time now"""
+        stream = self.stream
+        ntp = now + NTP_EPOCH_OFFSET
+        seconds = int(ntp)
+        packets = stream.packets_sent
+        return _RTCP_SR.pack(
+            0x80, RTCP_SR, 6, stream.ssrc,
+            seconds & 0xFFFFFFFF, int((ntp - seconds) * 0x100000000) & 0xFFFFFFFF,
+            stream.timestamp, packets & 0xFFFFFFFF, (packets * FRAME_SAMPLES) & 0xFFFFFFFF,
+        ) + self.sdes
+
+    def send_report(self):
+        self.next_report = time.monotonic() + random.uniform(0.5, 1.5) * RTCP_INTERVAL
+        try:
+            self.sock.sendto(self.sender_report(time.time()), self.target)
+        except OSError:
+            pass
+
+    def receive(self):
+        """Drain the socket; returns the report blocks about our stream that were read"""
+        blocks = 0
+        while True:
+            try:
+                data = self.sock.recv(2048)
+            except (BlockingIOError, InterruptedError):
+                return blocks
+            except OSError:
+                # ICMP errors for our own reports surface here; they are not RTCP from the phone
+                continue
+            blocks += self.parse(data)
+
+    def parse(self, data):
+        """Walk a compound packet and pick out report blocks for our SSRC"""
+        blocks = 0
+        offset = 0
+        while offset + 4 <= len(data):
+            first, packet_type, length = _RTCP_HEADER.unpack_from(data, offset)
+            end = offset + (length + 1) * 4
+            if first >> 6 != 2 or end > len(data):
+                break
+            self.last_received = time.monotonic()
+            if packet_type in (RTCP_SR, RTCP_RR):
+                position = offset + (28 if packet_type == RTCP_SR else 8)
+                for _ in range(first & 0x1F):
+                    if position + _RTCP_REPORT_BLOCK.size > end:
+                        break
+                    block = _RTCP_REPORT_BLOCK.unpack_from(data, position)
+                    position += _RTCP_REPORT_BLOCK.size
+                    if block[0] == self.stream.ssrc:
+                        self.update(*block[1:])
+                        blocks += 1
+            offset = end
+        return blocks
+
+    def update(self, lost, highest_sequence, jitter, last_sr, delay_since_sr):
+        self.reports += 1
+        self.fraction_lost = (lost >> 24) / 256
+        cumulative = lost & 0xFFFFFF
+        # Cumulative loss is a signed 24-bit count (duplicates can make it negative)
+        self.cumulative_lost = cumulative - 0x1000000 if cumulative & 0x800000 else cumulative
+        self.highest_sequence = highest_sequence
+        self.jitter = jitter / SAMPLE_RATE
+        if last_sr:
+            # Round trip in 1/65536 s: now (middle 32 bits of NTP) - LSR - DLSR (RFC 3550 6.4.1)
+            now = int((time.time() + NTP_EPOCH_OFFSET) * 65536) & 0xFFFFFFFF
+            self.rtt = ((now - last_sr - delay_since_sr) & 0xFFFFFFFF) / 65536
+
+    def close(self, bye=True):
+        """Send BYE (unless the SSRC lives on in a restarted server) and release the socket"""
+        if bye:
+            try:
+                self.sock.sendto(self.sender_report(time.time()) +
+                                 _RTCP_HEADER.pack(0x81, RTCP_BYE, 1) + struct.pack('!I', self.stream.ssrc),
+                                 self.target)
+            except OSError:
+                pass
+        self.sock.close()
+
+
+class RTPPortPool:
+    """Free-list of even RTP ports from a range; port + 1 is implicitly reserved for RTCP"""
+
+    def __init__(self, start=10000, end=10100):
+        first = start + (start % 2)
+        # FIFO reuse: a released port goes to the back so late packets of an old
+        # call do not land on a new one
+        self._free = deque(range(first, end, 2))
+        self.start = first
+        self.end = end
+        self._in_use = set()
+        self._lock = threading.Lock()
+        self.size = len(self._free)
+
+    def allocate(self):
+        """Return a free even port, or None when the pool is exhausted"""
+        with self._lock:
+            if not self._free:
+                return None
+            port = self._free.popleft()
+            self._in_use.add(port)
+            return port
+
+    def release(self, port):
+        with self._lock:
+            if port in self._in_use:
+                self._in_use.remove(port)
+                if self.start <= port < self.end:
+                    self._free.append(port)
+
+    def claim(self, port):
+        """Take one specific free port (a resumed call's); False if it is not available"""
+        with self._lock:
+            if port in self._in_use or port not in self._free:
+                return False
+            self._free.remove(port)
+            self._in_use.add(port)
+            return True
+
+    def resize(self, start, end):
+        """Move to a new range; ports in use stay allocated and leave the pool when released"""
+        first = start + (start % 2)
+        with self._lock:
+            self._free = deque(port for port in range(first, end, 2) if port not in self._in_use)
+            self.start = first
+            self.end = end
+            self.size = len(range(first, end, 2))
+
+    def __len__(self):
+        """Number of ports currently allocated"""
+        return len(self._in_use)
+
+
+# Playlist used for Request-URI users without their own entry
+DEFAULT_PLAYLIST = 'default'
+
+
+class Call:
+    """State of one held call"""
+
+    def __init__(self, call_id, rtp_port, remote_addr):
+        self.call_id = call_id
+        self.rtp_port = rtp_port
+        self.remote_addr = remote_addr
+        self.media_target = None
+        self.payload_type = PAYLOAD_TYPE_PCMU
+        self.encoding = 'PCMU'
+        self.direction = 'sendonly'
+        self.answer_sdp = None
+        # Parsed SDP offer of the INVITE, kept until the 200 OK answers it
+        self.offer = None
+        self.playlist = DEFAULT_PLAYLIST
+        self.stream = None
+        self.rtcp = None
+        self.rtcp_port = None
+        self.started = time.monotonic()
+        # Dialog state needed to send our own BYE
+        self.sock = None
+        self.transport = 'UDP'
+        # Our address as advertised to this caller in Contact, Via and SDP
+        self.local_address = None
+        self.local_party = None
+        self.remote_party = None
+        self.remote_target = None
+        self.route_set = []
+        self.local_cseq = 0
+        # Session timer (RFC 4028) and expiry deadlines by reason
+        self.session_interval = None
+        # Who sends the refreshes ('uac': the phone, 'uas': us) and how we send ours
+        self.refresher = 'uac'
+        self.refresh_method = 'UPDATE'
+        # CSeq of our latest refresh, to match its responses
+        self.refresh_cseq = None
+        self.deadlines = {}
+
+
+class CallTimers:
+    """Min-heap of call deadlines; O(log n) to schedule and to expire
+
+    Rescheduling pushes a new entry and leaves the old one in place; stale
+    entries are recognised when popped because they no longer match the
+    call's current deadline for that reason.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, call, reason, deadline):
+        call.deadlines[reason] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), call, reason))
+
+    def cancel(self, call, reason):
+        call.deadlines.pop(reason, None)
+
+    def pop_due(self, now):
+        """Yield (call, reason) for every live deadline at or before now"""
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, _, call, reason = heapq.heappop(heap)
+            if call.deadlines.get(reason) == deadline:
+                del call.deadlines[reason]
+                yield call, reason
+
+
+# Call timer reason that sends a session refresh instead of ending the call
+SESSION_REFRESH_DUE = 'session refresh due'
+# Seconds before an unanswered session refresh is sent again
+SESSION_REFRESH_RETRY = 4.0
+
+
+# Bytes on the wire per RTP packet besides the payload: RTP (12) + UDP (8) + IPv4 (20) headers
+RTP_PACKET_OVERHEAD = 40
+
+
+class AdmissionControl:
+    """Decides whether a new INVITE can be taken without hurting the calls already on hold
+
+    CPU is sampled from the process clock on the reaper tick, not per INVITE, so a
+    burst of INVITEs is judged against one recent measurement. A limit of 0 is off.
+    """
+
+    def __init__(self, max_calls=0, max_cpu=0.9, max_bandwidth=0, retry_after=30):
+        self.max_calls = max_calls
+        # Share of one core used by this process (media clock thread included)
+        self.max_cpu = max_cpu
+        # Outbound media in kbit/s
+        self.max_bandwidth = max_bandwidth
+        self.retry_after = retry_after
+        self.cpu = 0.0
+        self._sampled = (time.monotonic(), time.process_time())
+
+    def sample(self, background=0.0):
+        """Measure the CPU share used since the previous sample
+
+        background is CPU time spent so far on work that ends by itself (encoding new
+        audio), left out so it does not turn callers away while it runs.
+        """
+        now, cpu = time.monotonic(), time.process_time() - background
+        elapsed = now - self._sampled[0]
+        if elapsed > 0:
+            self.cpu = (cpu - self._sampled[1]) / elapsed
+        self._sampled = (now, cpu)
+
+    @staticmethod
+    def call_bandwidth():
+        """Outbound kbit/s of one held call; every codec sends FRAME_SAMPLES bytes per frame"""
+        return (FRAME_SAMPLES + RTP_PACKET_OVERHEAD) * 8 / FRAME_INTERVAL / 1000
+
+    def check(self, calls):
+        """Name the limit one more call would exceed, or None to admit it"""
+        if self.max_calls and calls >= self.max_calls:
+            return 'calls'
+        if self.max_bandwidth and (calls + 1) * self.call_bandwidth() > self.max_bandwidth:
+            return 'bandwidth'
+        if self.max_cpu and self.cpu >= self.max_cpu:
+            return 'cpu'
+        return None
+
+    def retry_after_header(self):
+        # Spread the retries so rejected callers do not all come back in the same second
+        return f"Retry-After: {self.retry_after + random.randint(0, self.retry_after // 2)}"
+
+
+class CallJournal:
+    """Append-only JSON-lines record of held calls, so a restarted server can take them back
+
+    Each line is a snapshot of one call ({"call": {...}}) or its end
+    ({"end": call_id}); the last line for a Call-ID wins. A background thread
+    does the writing, so the event loop never waits on the disk, and rewrites
+    the file with only the live calls once it has grown well past them.
+    """
+
+    # Superseded lines tolerated before the file is compacted
+    COMPACT_AFTER = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+        self.write_errors = 0
+        self._queue = queue.SimpleQueue()
+        # Owned by the writer thread once it has started
+        self._snapshots = {}
+        self._lines = 0
+        self._thread = None
+
+    def load(self):
+        """Snapshots of the calls that had not ended, by Call-ID"""
+        calls = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn last line from a crash in the middle of a write
+                        continue
+                    if 'call' in entry:
+                        calls[entry['call']['call_id']] = entry['call']
+                    elif 'end' in entry:
+                        calls.pop(entry['end'], None)
+        except FileNotFoundError:
+            pass
+        return calls
+
+    def start(self, snapshots=()):
+        """Rewrite the file with just these snapshots and start the writer thread"""
+        self._rewrite(snapshots)
+        self._thread = threading.Thread(target=self._run, name='moh-journal', daemon=True)
+        self._thread.start()
+        return self
+
+    def record(self, snapshot):
+        if not self.closed:
+            self._queue.put(('call', snapshot))
+
+    def end(self, call_id):
+        if not self.closed:
+            self._queue.put(('end', call_id))
+
+    def close(self):
+        """Write what is queued and stop; calls still in the file are resumed on the next start"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+    def _rewrite(self, snapshots):
+        self._snapshots = {snapshot['call_id']: snapshot for snapshot in snapshots}
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as f:
+            for snapshot in self._snapshots.values():
+                f.write(json.dumps({'call': snapshot}) + '\n')
+        os.replace(temporary, self.path)
+        self._lines = len(self._snapshots)
+
+    def _run(self):
+        f = open(self.path, 'a', encoding='utf-8')
+        try:
+            while True:
+                entries = [self._queue.get()]
+                # Batch whatever piled up during the last write
+                try:
+                    while True:
+                        entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    pass
+                try:
+                    for entry in entries:
+                        if entry is None:
+                            continue
+                        kind, value = entry
+                        if kind == 'call':
+                            self._snapshots[value['call_id']] = value
+                            f.write(json.dumps({'call': value}) + '\n')
+                        else:
+                            self._snapshots.pop(value, None)
+                            f.write(json.dumps({'end': value}) + '\n')
+                        self._lines += 1
+                    # Flushed to the kernel: survives a crash of this process, not of the machine
+                    f.flush()
+                    if self._lines > 2 * len(self._snapshots) + self.COMPACT_AFTER:
+                        f.close()
+                        self._rewrite(list(self._snapshots.values()))
+                        f = open(self.path, 'a', encoding='utf-8')
+                except OSError:
+                    self.write_errors += 1
+                if None in entries:
+                    return
+        finally:
+            f.close()
+
+
+# Histogram buckets (seconds)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+LATENESS_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.04, 0.1)
+RTCP_JITTER_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16)
+RTCP_RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Fraction of packets lost in a report interval
+RTCP_LOSS_BUCKETS = (0.0, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+# A tick that starts this late is counted as a late frame
+LATE_FRAME_THRESHOLD = FRAME_INTERVAL / 2
+# Frames sent back-to-back to recover from a stall; further behind, missed frames are dropped
+MAX_CATCHUP_FRAMES = 3
+
+# Label values allowed for the method label; anything else is reported as "other"
+METRIC_METHODS = frozenset(('INVITE', 'ACK', 'BYE', 'CANCEL', 'OPTIONS', 'REGISTER', 'UPDATE',
+                            'INFO', 'PRACK', 'SUBSCRIBE', 'NOTIFY', 'REFER', 'MESSAGE', 'PUBLISH'))
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is one bisect and two additions"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{le="{bound}"}} {cumulative}'
+        cumulative += self.counts[-1]
+        yield f'{name}_bucket{{le="+Inf"}} {cumulative}'
+        yield f'{name}_sum {self.sum}'
+        yield f'{name}_count {cumulative}'
+
+
+class Metrics:
+    """Counters and histograms updated in place, rendered in Prometheus text format on scrape
+
+    Values that already exist elsewhere (active calls, ports in use, ...) are
+    registered as callbacks so the hot path does no extra bookkeeping for them.
+    """
+
+    def __init__(self):
+        self._families = {}
+        self._counters = {}
+        self._histograms = {}
+        self._callbacks = {}
+
+    def _describe(self, name, kind, help_text):
+        self._families.setdefault(name, (kind, help_text))
+
+    def counter(self, name, help_text):
+        self._describe(name, 'counter', help_text)
+
+    def inc(self, name, labels='', amount=1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def histogram(self, name, help_text, buckets):
+        self._describe(name, 'histogram', help_text)
+        histogram = self._histograms[name] = Histogram(buckets)
+        return histogram
+
+    def callback(self, name, kind, help_text, func):
+        self._describe(name, kind, help_text)
+        self._callbacks[name] = func
+
+    def render(self):
+        lines = []
+        counters = sorted(self._counters.items())
+        for name, (kind, help_text) in sorted(self._families.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self._histograms:
+                lines.extend(self._histograms[name].samples(name))
+            elif name in self._callbacks:
+                lines.append(f"{name} {self._callbacks[name]()}")
+            else:
+                for (counter_name, labels), value in counters:
+                    if counter_name == name:
+                        lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class MediaBroadcaster:
+    """One clock that picks each 20 ms frame once and fans it out to every stream"""
+
+    def __init__(self, frames, lateness=None):
+        self.frames = frames
+        self.position = 0
+        # Written only by the clock thread, read by metrics scrapes
+        self.ticks = 0
+        self.packets_sent = 0
+        self.late_frames = 0
+        self.dropped_frames = 0
+        self.underrun_frames = 0
+        # Smoothed deviation of the tick interval from 20 ms (RFC 3550 section 6.4.1 estimator)
+        self.jitter = 0.0
+        self.lateness = lateness or Histogram(LATENESS_BUCKETS)
+        # New audio handed over by swap(), picked up by the clock at the next frame
+        self._pending = None
+        self._streams = {}
+        # Immutable snapshot read by the send loop without taking the lock
+        self._snapshot = ()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def add(self, key, stream):
+        with self._lock:
+            self._streams[key] = stream
+            self._snapshot = tuple(self._streams.values())
+        self._wakeup.set()
+
+    def remove(self, key):
+        with self._lock:
+            stream = self._streams.pop(key, None)
+            self._snapshot = tuple(self._streams.values())
+        return stream
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def swap(self, frames):
+        """Switch to new audio at the next frame boundary; safe to call from any thread"""
+        self._pending = frames
+
+    @property
+    def next_frames(self):
+        """Audio the clock plays from the next frame on, including a swap not yet picked up"""
+        pending = self._pending
+        return self.frames if pending is None else pending
+
+    def tick(self):
+        """Send the current frame to every stream and advance the shared position"""
+        pending = self._pending
+        if pending is not None:
+            self._pending = None
+            self.frames = pending
+            self.position = 0
+        frames = self.frames
+        position = self.position
+        streams = self._snapshot
+        self.ticks += 1
+        if position >= len(frames):
+            if not getattr(frames, 'complete', True):
+                # Playback caught up with encoding: wait at the end for the next frame
+                # rather than loop back to the start of a track that is not finished
+                for stream in streams:
+                    stream.skip(1)
+                self.underrun_frames += 1
+                return
+            position = 0
+        payload = frames[position]
+        self.position = position + 1
+        for stream in streams:
+            stream.send(payload)
+        self.packets_sent += len(streams)
+
+    def skip(self, frames):
+        """Drop frames after a stall so the music and RTP clocks stay in step with real time"""
+        position = self.position + frames
+        if getattr(self.frames, 'complete', True):
+            self.position = position % len(self.frames)
+        else:
+            self.position = min(position, len(self.frames))
+        for stream in self._snapshot:
+            stream.skip(frames)
+        self.dropped_frames += frames
+
+    def _run(self):
+        # Pace against absolute deadlines so send time does not accumulate as drift
+        deadline = time.monotonic()
+        last_tick = None
+        while not self._stopped.is_set():
+            if not self._snapshot:
+                self._wakeup.clear()
+                self._wakeup.wait()
+                deadline = time.monotonic()
+                last_tick = None
+                continue
+
+            now = time.monotonic()
+            late = now - deadline
+            if late > MAX_CATCHUP_FRAMES * FRAME_INTERVAL:
+                # Too far behind to catch up by bursting (e.g. a scheduling stall or suspend)
+                missed = int(late / FRAME_INTERVAL)
+                self.skip(missed)
+                deadline += missed * FRAME_INTERVAL
+                late -= missed * FRAME_INTERVAL
+            self.lateness.observe(late)
+            if late > LATE_FRAME_THRESHOLD:
+                self.late_frames += 1
+            if last_tick is not None:
+                self.jitter += (abs(now - last_tick - FRAME_INTERVAL) - self.jitter) / 16
+            last_tick = now
+
+            self.tick()
+            deadline += FRAME_INTERVAL
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._stopped.wait(delay)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=1.0)
+
+
+# RFC 3261 timer values for unreliable transports (seconds)
+T1 = 0.5
+T2 = 4.0
+T4 = 5.0
+TIMER_H = 64 * T1
+TIMER_J = 64 * T1
+
+# Compact header forms (RFC 3261 section 7.3.3 and extensions) -> canonical lower-case name
+COMPACT_HEADERS = {
+    'i': 'call-id', 'v': 'via', 'f': 'from', 't': 'to', 'm': 'contact',
+    'l': 'content-length', 'c': 'content-type', 'e': 'content-encoding',
+    'k': 'supported', 's': 'subject', 'o': 'event', 'r': 'refer-to',
+    'b': 'referred-by', 'u': 'allow-events', 'x': 'session-expires',
+}
+
+_COMPACT_KEYS = {short.encode(): full.encode() for short, full in COMPACT_HEADERS.items()}
+_COMPACT_NAMES = frozenset(_COMPACT_KEYS)
+
+# Header name as given by callers -> index key (lower-case full form)
+_HEADER_KEYS = {}
+# Headers a response copies from its request, in the order it lists them
+_DIALOG_KEYS = (b'via', b'from', b'to', b'call-id', b'cseq')
+_DIALOG_KEYSET = frozenset(_DIALOG_KEYS)
+# The same headers as they start a line in canonical spelling
+_DIALOG_NAMES = ('Via:', 'From:', 'To:', 'Call-ID:', 'CSeq:')
+
+
+def _header_key(name):
+    key = name.lower().encode()
+    key = _HEADER_KEYS[name] = _COMPACT_KEYS.get(key, key)
+    return key
+
+
+# Name of every header line that is a plain token followed directly by a colon
+_HEADER_NAME_RE = re.compile(rb'\n([^: \t\r\n]*):')
+# Every dialog header line (full or compact name) and its name
+_DIALOG_LINE_RE = re.compile(rb'\n((via|v|from|f|to|t|call-id|i|cseq)[ \t]*:[^\r\n]*)', re.IGNORECASE)
+_BRANCH_RE = re.compile(r';\s*branch\s*=\s*([^;,\s]+)', re.IGNORECASE)
+# Content-Length (or compact l) inside a header block, for framing stream transports
+_CONTENT_LENGTH_RE = re.compile(rb'\r\n(?:content-length|l)[ \t]*:[ \t]*(\d+)', re.IGNORECASE)
+
+
+class SIPMessage:
+    """SIP message parsed in place from the received bytes
+
+    Parsing only finds the start line. The header index (lower-case name ->
+    raw line) is built on first use, in one of two sizes: asking for Via,
+    From, To, Call-ID or CSeq (all that a transaction key or a response
+    needs) indexes just those five with one regex pass over the block;
+    asking for anything else indexes every header. Values are only decoded
+    when asked for. Compact forms, repeated headers (multi-hop Via) and
+    folded lines are handled by both.
+    """
+
+    __slots__ = ('data', 'start_line', 'method', 'headers', 'repeated', 'body_offset', 'advertised',
+                 'transport', '_header_start', '_header_end', '_complete')
+
+    def __init__(self, data):
+        if type(data) is not bytes:
+            data = bytes(data)
+        self.data = data
+        # Our address as the sender should see it (Contact, Via, SDP) and the transport
+        # it arrived over ('UDP', 'TCP' or 'TLS'); set on receipt
+        self.advertised = None
+        self.transport = 'UDP'
+        # Built on first use: first line of each indexed header, and the lines of headers
+        # that occur more than once (None when there are none)
+        self.headers = None
+        self.repeated = None
+        # True once every header is indexed, not just the dialog headers
+        self._complete = False
+
+        header_end = data.find(b'\r\n\r\n')
+        if header_end < 0:
+            header_end = len(data)
+            self.body_offset = header_end
+        else:
+            self.body_offset = header_end + 4
+        # The header block runs from the CRLF ending the start line to header_end
+        start_end = data.find(b'\r\n', 0, header_end)
+        if start_end < 0:
+            start_end = header_end
+        self._header_start = start_end
+        self._header_end = header_end
+        self.start_line = start_line = data[:start_end].decode('utf-8', 'replace')
+        self.method = start_line.split(' ', 1)[0].upper()
+
+    def _index(self, key):
+        """Index enough of the header block to look key up"""
+        if self.headers is None and key in _DIALOG_KEYSET:
+            self._index_dialog()
+        else:
+            self._index_all()
+
+    def _index_dialog(self):
+        """Index only the dialog headers, with one regex pass over the block"""
+        data, start, end = self.data, self._header_start, self._header_end
+        if data.find(b'\n ', start, end) >= 0 or data.find(b'\n\t', start, end) >= 0:
+            # Folded lines need the line-by-line pass
+            self._index_all()
+            return
+        pairs = []
+        for line, name in _DIALOG_LINE_RE.findall(data, start, end):
+            name = name.lower()
+            pairs.append((_COMPACT_KEYS.get(name, name), line))
+        self._store(pairs)
+
+    def _index_all(self):
+        """Index every header"""
+        block = self.data[self._header_start:self._header_end]
+        lines = block.split(b'\r\n')
+        del lines[0]
+        self._complete = True
+        # Names come from one regex pass over the lower-cased block; a line it cannot name
+        # (folded, white space before the colon, no colon) leaves the counts unequal
+        names = _HEADER_NAME_RE.findall(block.lower())
+        self.headers = headers = dict(zip(names, lines))
+        self.repeated = None
+        if len(names) != len(lines) or len(headers) != len(lines) or not _COMPACT_NAMES.isdisjoint(headers):
+            # Repeated, compact or irregular headers
+            self._index_lines(lines)
+
+    def _index_lines(self, lines):
+        """Index every header in one Python pass (compact, repeated or folded headers)"""
+        pairs = []
+        for line in lines:
+            if line[:1] in (b' ', b'\t'):
+                # Folded continuation line extends the previous header
+                if pairs:
+                    key, previous = pairs[-1]
+                    pairs[-1] = (key, previous + b' ' + line.lstrip())
+                continue
+            name, colon, _ = line.partition(b':')
+            if colon:
+                key = name.rstrip().lower()
+                pairs.append((_COMPACT_KEYS.get(key, key), line))
+        self._store(pairs)
+
+    def _store(self, pairs):
+        headers = {}
+        repeated = {}
+        for key, line in pairs:
+            if key not in headers:
+                headers[key] = line
+            elif key in repeated:
+                repeated[key].append(line)
+            else:
+                repeated[key] = [headers[key], line]
+        self.headers = headers
+        self.repeated = repeated or None
+
+    def _lines(self, name):
+        key = _HEADER_KEYS.get(name) or _header_key(name)
+        if not self._complete and (self.headers is None or key not in _DIALOG_KEYSET):
+            self._index(key)
+        if self.repeated and key in self.repeated:
+            return self.repeated[key]
+        line = self.headers.get(key)
+        return () if line is None else (line,)
+
+    @property
+    def is_response(self):
+        return self.start_line.startswith('SIP/')
+
+    def get(self, name, default=None):
+        """Value of the first header called name (full or compact form)"""
+        key = _HEADER_KEYS.get(name) or _header_key(name)
+        if not self._complete and (self.headers is None or key not in _DIALOG_KEYSET):
+            self._index(key)
+        line = self.headers.get(key)
+        if line is None:
+            return default
+        return line.partition(b':')[2].decode('utf-8', 'replace').strip()
+
+    def get_all(self, name):
+        """Values of every header line called name, in order"""
+        return [line.partition(b':')[2].decode('utf-8', 'replace').strip() for line in self._lines(name)]
+
+    def raw_lines(self, *names):
+        """Whole header lines for each of names, in that order, as received"""
+        return [line for name in names for line in self._lines(name)]
+
+    def dialog_lines(self, tag_param):
+        """Via, From, To, Call-ID and CSeq lines as a response copies them, in that order
+
+        tag_param (b';tag=...') is appended to a To line that has no tag yet.
+        """
+        if self.headers is None:
+            self._index_dialog()
+        if self.repeated is None:
+            lines = list(map(self.headers.get, _DIALOG_KEYS))
+            if None not in lines:
+                if b'tag=' not in lines[2]:
+                    lines[2] += tag_param
+                return lines
+        lines = self.raw_lines('via', 'from')
+        lines.extend(line if b'tag=' in line else line + tag_param for line in self._lines('to'))
+        lines.extend(self.raw_lines('call-id', 'cseq'))
+        return lines
+
+    def vias(self):
+        """Every Via value, top first, with comma-combined Via headers split out"""
+        return [via.strip() for value in self.get_all('via') for via in value.split(',') if via.strip()]
+
+    def branch(self):
+        """branch parameter of the top Via, or None"""
+        via = self.get('via')
+        match = _BRANCH_RE.search(via.split(',', 1)[0]) if via else None
+        return match.group(1) if match else None
+
+    def cseq(self):
+        """(sequence number, method) from CSeq, or (None, None)"""
+        parts = (self.get('cseq') or '').split()
+        if len(parts) < 2:
+            return None, None
+        try:
+            return int(parts[0]), parts[1].upper()
+        except ValueError:
+            return None, parts[1].upper()
+
+    @property
+    def body(self):
+        length = self.get('content-length')
+        end = len(self.data)
+        if length and length.isdigit():
+            end = min(end, self.body_offset + int(length))
+        return self.data[self.body_offset:end]
+
+
+class ResponseTemplates:
+    """Byte fragments of stateless responses, built once at startup
+
+    Keepalive answers (OPTIONS/REGISTER 200, 501 for anything unknown) only
+    copy the Via/From/To/Call-ID/CSeq lines of the request between a
+    precomputed status line and a precomputed header tail. OPTIONS and
+    REGISTER are answered from the received bytes with one pass over the
+    lines, without parsing a SIPMessage. A fixed To-tag makes the answer to a
+    retransmission identical, so no transaction state is needed.
+    """
+
+    STATUS = {200: 'OK', 501: 'Not Implemented'}
+
+    def __init__(self, host, contact, tag, user_agent='MoH-Server/1.0'):
+        # Status line and its CRLF, per status code
+        self.heads = {code: f"SIP/2.0 {code} {text}\r\n".encode() for code, text in self.STATUS.items()}
+        self.tag_text = f";tag={tag}"
+        self.tag_param = self.tag_text.encode()
+        self.host = host
+        # contact(address, transport) -> Contact URI
+        self.contact = contact
+        self.user_agent = user_agent
+        # One header tail per advertised address and transport; a host has only a handful
+        self._tails = {}
+
+    def tail(self, host, transport='UDP'):
+        key = (host, transport)
+        tail = self._tails.get(key)
+        if tail is None:
+            tail = self._tails[key] = (f"\r\nContact: {self.contact(host, transport)}\r\n"
+                                       f"Content-Length: 0\r\n"
+                                       f"User-Agent: {self.user_agent}\r\n\r\n").encode()
+        return tail
+
+    def render(self, request, status_code):
+        key = (request.advertised or self.host, request.transport)
+        return (self.heads[status_code] + b'\r\n'.join(request.dialog_lines(self.tag_param))
+                + (self._tails.get(key) or self.tail(*key)))
+
+    def answer(self, data, status_code, host, transport='UDP'):
+        """Response to a request still in bytes, or None to fall back to render()
+
+        Only the canonical header names are matched, so a request using a
+        compact or oddly cased dialog header, or folding one, is missing a
+        line here and is left to the full parser.
+        """
+        text = data.decode('utf-8', 'surrogateescape')
+        end = text.find('\r\n\r\n')
+        lines = []
+        # Non-Via dialog headers seen; exactly one each is expected
+        found = 0
+        matched = False
+        for line in (text[:end] if end >= 0 else text).split('\r\n'):
+            if matched and line[:1] in ' \t':
+                return None
+            matched = line.startswith(_DIALOG_NAMES)
+            if matched:
+                first = line[:1]
+                if first == 'V':
+                    found -= 1
+                elif first == 'T' and 'tag=' not in line:
+                    line += self.tag_text
+                found += 1
+                lines.append(line)
+        if found != 4:
+            return None
+        key = (host or self.host, transport)
+        return (self.heads[status_code] + '\r\n'.join(lines).encode('utf-8', 'surrogateescape')
+                + (self._tails.get(key) or self.tail(*key)))
+
+
+def transaction_key(request):
+    """Key a request by top Via branch, Call-ID and CSeq method (ACK matches its INVITE)"""
+    method = request.cseq()[1] or request.method
+    if method == 'ACK':
+        method = 'INVITE'
+    return (request.branch(), request.get('call-id'), method)
+
+
+class ServerTransaction:
+    """One server transaction; responses are sent through it so they can be replayed"""
+
+    def __init__(self, table, key, sock, addr):
+        self.table = table
+        self.key = key
+        self.call_id = key[1]
+        self.sock = sock
+        self.addr = addr
+        self.reliable = isinstance(sock, StreamConnections)
+        self.to_tag = None
+        self.call = None
+        self.last_response = None
+        self.acked = False
+        self._timers = []
+
+    @property
+    def is_invite(self):
+        return self.key[2] == 'INVITE'
+
+    def sendto(self, data, addr):
+        self.sock.sendto(data, addr)
+        self.addr = addr
+        self.last_response = data
+        if data[8:9] != b'1':
+            self.table.final_response_sent(self)
+
+    def retransmit(self):
+        """Resend the most recent response, if any"""
+        if self.last_response is not None:
+            self.sock.sendto(self.last_response, self.addr)
+
+    def schedule(self, delay, callback, *args):
+        self._timers.append(self.table.loop.call_later(delay, callback, *args))
+
+    def cancel_timers(self):
+        for timer in self._timers:
+            timer.cancel()
+        self._timers = []
+
+
+class TransactionTable:
+    """Server transactions keyed by Via branch and Call-ID, expired on Timer H/J"""
+
+    def __init__(self, loop, on_timeout=None):
+        self.loop = loop
+        self.on_timeout = on_timeout
+        self.transactions = {}
+        # Call-ID -> INVITE transaction whose final response has not been ACKed yet
+        self.awaiting_ack = {}
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def get(self, key):
+        return self.transactions.get(key)
+
+    def create(self, key, sock, addr):
+        transaction = ServerTransaction(self, key, sock, addr)
+        self.transactions[key] = transaction
+        return transaction
+
+    def final_response_sent(self, transaction):
+        transaction.cancel_timers()
+        if transaction.is_invite:
+            # Timer G retransmits the final response until the ACK arrives; Timer H gives up.
+            # Over TCP/TLS only a 2xx is retransmitted (RFC 3261 13.3.1.4)
+            self.awaiting_ack[transaction.call_id] = transaction
+            if not transaction.reliable or transaction.last_response[8:9] == b'2':
+                transaction.schedule(T1, self._timer_g, transaction, T1)
+            transaction.schedule(TIMER_H, self._timer_h, transaction)
+        else:
+            # Timer J keeps the entry around to absorb request retransmissions
+            transaction.schedule(TIMER_J, self.terminate, transaction)
+
+    def _timer_g(self, transaction, interval):
+        if transaction.acked or self.transactions.get(transaction.key) is not transaction:
+            return
+        try:
+            transaction.retransmit()
+        except OSError:
+            pass
+        interval = min(interval * 2, T2)
+        transaction.schedule(interval, self._timer_g, transaction, interval)
+
+    def _timer_h(self, transaction):
+        self.terminate(transaction)
+        if self.on_timeout:
+            self.on_timeout(transaction)
+
+    def ack(self, key):
+        """Match an ACK to its INVITE transaction; returns the transaction or None"""
+        transaction = self.transactions.get(key)
+        if transaction is None or not transaction.is_invite:
+            # ACK for a 2xx carries a new branch, so fall back to the dialog's Call-ID
+            transaction = self.awaiting_ack.get(key[1])
+        if transaction is None or transaction.acked:
+            return None
+        transaction.acked = True
+        transaction.cancel_timers()
+        if self.awaiting_ack.get(transaction.call_id) is transaction:
+            del self.awaiting_ack[transaction.call_id]
+        # Timer I absorbs ACK retransmissions before the entry is dropped
+        transaction.schedule(T4, self.terminate, transaction)
+        return transaction
+
+    def end_dialog(self, call_id):
+        """Stop retransmitting an unacknowledged final response for a finished call"""
+        transaction = self.awaiting_ack.pop(call_id, None)
+        if transaction:
+            self.terminate(transaction)
+
+    def terminate(self, transaction):
+        transaction.cancel_timers()
+        if self.transactions.get(transaction.key) is transaction:
+            del self.transactions[transaction.key]
+        if self.awaiting_ack.get(transaction.call_id) is transaction:
+            del self.awaiting_ack[transaction.call_id]
+
+
+# Codecs we can send: encoding name -> static RTP payload type
+_STATIC_PAYLOAD_TYPES = {PAYLOAD_TYPE_PCMU: 'PCMU', PAYLOAD_TYPE_PCMA: 'PCMA', PAYLOAD_TYPE_G722: 'G722'}
+_DIRECTIONS = ('sendrecv', 'sendonly', 'recvonly', 'inactive')
+
+
+class MediaDescription:
+    """One m= section of an SDP body"""
+
+    def __init__(self, media, port, proto, formats):
+        self.media = media
+        self.port = port
+        self.proto = proto
+        self.formats = formats
+        self.connection = None
+        self.rtpmap = {}
+        self.direction = None
+        # a=rtcp (RFC 3605); None means the RTP port + 1
+        self.rtcp_port = None
+
+
+class SessionDescription:
+    """The parts of an SDP body (RFC 4566) needed for offer/answer"""
+
+    def __init__(self):
+        self.connection = None
+        self.direction = 'sendrecv'
+        self.media = []
+
+    def audio(self):
+        """First audio m= section, or None"""
+        for media in self.media:
+            if media.media == 'audio':
+                return media
+        return None
+
+    def media_address(self, media):
+        """Connection address for a media section (media-level c= overrides session-level)"""
+        return media.connection or self.connection
+
+    def media_direction(self, media):
+        return media.direction or self.direction
+
+
+def parse_sdp(body):
+    """Parse an SDP body, ignoring lines this server does not use"""
+    session = SessionDescription()
+    current = None
+    for line in body.splitlines():
+        if len(line) < 2 or line[1] != '=':
+            continue
+        kind, value = line[0], line[2:].strip()
+        if kind == 'm':
+            parts = value.split()
+            if len(parts) < 3:
+                continue
+            try:
+                port = int(parts[1].split('/', 1)[0])
+            except ValueError:
+                continue
+            current = MediaDescription(parts[0], port, parts[2], parts[3:])
+            session.media.append(current)
+        elif kind == 'c':
+            # c=IN IP4 203.0.113.5 (multicast TTL suffixes are dropped)
+            parts = value.split()
+            address = parts[2].split('/', 1)[0] if len(parts) >= 3 else None
+            if current:
+                current.connection = address
+            else:
+                session.connection = address
+        elif kind == 'a':
+            if value in _DIRECTIONS:
+                if current:
+                    current.direction = value
+                else:
+                    session.direction = value
+            elif value.startswith('rtcp:') and current:
+                port = value[5:].split(' ', 1)[0]
+                if port.isdigit():
+                    current.rtcp_port = int(port)
+            elif value.startswith('rtpmap:') and current:
+                fmt, _, encoding = value[7:].partition(' ')
+                current.rtpmap[fmt] = encoding.strip()
+    return session
+
+
+def select_codec(media, enabled=tuple(CODECS)):
+    """Pick the first offered format we can send; returns (payload_type, encoding) or None"""
+    for fmt in media.formats:
+        encoding = media.rtpmap.get(fmt)
+        if encoding:
+            name = encoding.split('/', 1)[0].upper()
+        else:
+            try:
+                name = _STATIC_PAYLOAD_TYPES.get(int(fmt))
+            except ValueError:
+                continue
+        if name in enabled:
+            return int(fmt), name
+    return None
+
+
+def build_sdp(address, port, formats, direction='sendonly', session_id=None, offer=None, version=None):
+    """Build an SDP body with one audio stream; formats is a list of (payload_type, encoding)
+
+    Given the offer it answers, every offered m= line is echoed in order (RFC 3264
+    section 6): the first audio one carries our stream, the others are rejected with
+    port 0.
+    """
+    session_id = session_id or int(time.time())
+    network = 'IP6' if ':' in address else 'IP4'
+    audio = [
+        f"m=audio {port} RTP/AVP {' '.join(str(payload_type) for payload_type, _ in formats)}",
+        *(f'a=rtpmap:{payload_type} {encoding}/{SAMPLE_RATE}' for payload_type, encoding in formats),
+        f'a=rtcp:{port + 1}',
+        'a=ptime:20',
+        f'a={direction}',
+    ]
+    accepted = offer.audio() if offer else None
+    if accepted is None:
+        media = audio
+    else:
+        media = []
+        for offered in offer.media:
+            if offered is accepted:
+                media += audio
+            else:
+                media.append(f"m={offered.media} 0 {offered.proto} {' '.join(offered.formats) or '0'}")
+    return '\r\n'.join([
+        'v=0',
+        f'o=moh-server {session_id} {version or session_id} IN {network} {address}',
+        's=Music On Hold',
+        f'c=IN {network} {address}',
+        't=0 0',
+        *media,
+        '',
+    ])
+
+
+def media_target(session, media, source_addr):
+    """Choose where to send RTP for an offered media section
+
+    Honours the offered c=/m= address and port. A private or unspecified
+    address offered from a public signalling source is a phone behind NAT,
+    so the signalling source IP is used instead.
+    """
+    address = session.media_address(media)
+    try:
+        offered = ipaddress.ip_address(address)
+        source = ipaddress.ip_address(source_addr[0])
+    except (TypeError, ValueError):
+        return (source_addr[0], media.port)
+    if offered.is_unspecified or (offered.is_private and not source.is_private):
+        return (source_addr[0], media.port)
+    return (address, media.port)
+
+
+def header_uri(value):
+    """URI from a name-addr or addr-spec header value (Contact, From, To)"""
+    if not value:
+        return None
+    if '<' in value:
+        return value[value.index('<') + 1:].split('>', 1)[0].strip()
+    return value.split(';', 1)[0].strip()
+
+
+def request_user(request):
+    """User part of the Request-URI (sip:100@host -> '100'), or None"""
+    parts = request.start_line.split(' ')
+    if len(parts) < 2:
+        return None
+    uri = parts[1].split(';', 1)[0]
+    if '@' not in uri:
+        return None
+    return uri.split(':', 1)[-1].split('@', 1)[0] or None
+
+
+def session_expires(value):
+    """(interval, refresher) from a Session-Expires value; None for what is missing or unreadable"""
+    if not value:
+        return None, None
+    parts = value.split(';')
+    try:
+        interval = int(parts[0])
+    except ValueError:
+        interval = None
+    refresher = None
+    for param in parts[1:]:
+        name, _, param_value = param.partition('=')
+        if name.strip().lower() == 'refresher' and param_value.strip().lower() in ('uac', 'uas'):
+            refresher = param_value.strip().lower()
+    return interval, refresher
+
+
+def header_tokens(request, *names):
+    """Lower-cased comma-separated tokens from headers such as Supported/Require"""
+    return {token.strip().lower() for name in names for value in request.get_all(name)
+            for token in value.split(',') if token.strip()}
+
+
+# Identical WARNING/ERROR lines are written at most once per interval (seconds)
+LOG_REPEAT_INTERVAL = 10.0
+# Records waiting for the writer thread; beyond this they are dropped, never blocking the caller
+LOG_QUEUE_SIZE = 10000
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, for journald and docker log drivers"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RepeatFilter(logging.Filter):
+    """Rate-limit repeated WARNING+ lines, reporting how many were suppressed"""
+
+    def __init__(self, interval=LOG_REPEAT_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        # (level, message) -> [first time written in this window, suppressed count]
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.levelno, record.getMessage())
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry and record.created - entry[0] < self.interval:
+                entry[1] += 1
+                return False
+            if entry and entry[1]:
+                record.msg = f"{key[1]} (repeated {entry[1]} more times)"
+                record.args = None
+            self._seen[key] = [record.created, 0]
+            if len(self._seen) > 1000:
+                cutoff = record.created - self.interval
+                self._seen = {k: v for k, v in self._seen.items() if v[0] >= cutoff}
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the writer falls behind instead of blocking"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_log_listener = None
+_log_listener_pid = None
+
+
+def setup_logging(level='INFO', log_format='text'):
+    """Send the server's log records through a queue to a background writer thread"""
+    global _log_listener, _log_listener_pid
+    if _log_listener and _log_listener_pid == os.getpid():
+        _log_listener.stop()
+
+    handler = logging.StreamHandler(sys.stdout)
+    if log_format == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s %(message)s', '%Y-%m-%d %H:%M:%S'))
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RepeatFilter())
+
+    logger = logging.getLogger('moh')
+    logger.handlers[:] = [queue_handler]
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+
+    # A forked worker inherits the parent's listener without its thread; replace it
+    _log_listener = logging.handlers.QueueListener(queue_handler.queue, handler)
+    _log_listener_pid = os.getpid()
+    _log_listener.start()
+    return logger
+
+
+def flush_logging():
+    """Write out everything still queued; logging continues afterwards"""
+    if _log_listener and _log_listener._thread:
+        _log_listener.stop()
+        _log_listener.start()
+
+
+# Settings a configuration file may change at runtime; host and port need a restart
+RELOADABLE_SETTINGS = ('answer_delay', 'session_expires', 'min_se', 'max_call_duration', 'rtcp_timeout',
+                       'rtp_port_start', 'rtp_port_end', 'log_level',
+                       'max_calls', 'max_cpu', 'max_bandwidth', 'retry_after')
+
+
+def load_config_file(path):
+    """Read a configuration file, returning (playlists, settings)
+
+    Either a flat {"user": "track.wav" or ["a.wav", "b.wav"], ...} mapping, or
+    {"playlists": {...}, "<setting>": value, ...} with RELOADABLE_SETTINGS.
+    Relative track paths are resolved from the file's directory.
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{path}: expected an object mapping users to tracks")
+    settings = {}
+    if isinstance(config.get('playlists'), dict):
+        settings = {key: value for key, value in config.items() if key != 'playlists'}
+        config = config['playlists']
+        unknown = set(settings) - set(RELOADABLE_SETTINGS)
+        if unknown:
+            raise ValueError(f"{path}: unknown settings {', '.join(sorted(unknown))}")
+    base = os.path.dirname(os.path.abspath(path))
+    playlists = {}
+    for user, tracks in config.items():
+        if isinstance(tracks, str):
+            tracks = [tracks]
+        playlists[str(user)] = [os.path.join(base, track) for track in tracks]
+    return playlists, settings
+
+
+class ClusterState:
+    """State shared by SO_REUSEPORT worker processes, created before forking
+
+    The kernel spreads datagrams over workers by source address, so a BYE can
+    land on a different worker than its INVITE. Every Call-ID therefore has an
+    owner (a hash of the Call-ID) and other workers hand its datagrams over a
+    Unix datagram socket. Per-worker active-call counts live in shared memory.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.index = 0
+        # One slot per worker, each written only by its own worker
+        self.calls = multiprocessing.Array('i', workers, lock=False)
+        self.channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workers)]
+
+    def owner(self, call_id):
+        return zlib.crc32(call_id.encode('utf-8', 'replace')) % self.workers
+
+    def forward(self, worker, addr, data, local=None):
+        """Hand a datagram to its owning worker together with the sender's and our address"""
+        try:
+            self.channels[worker][1].send(f"{addr[0]} {addr[1]} {local or '-'}\n".encode() + data)
+        except OSError:
+            pass
+
+    def port_range(self, start, end):
+        """This worker's disjoint slice of the RTP port range, so pools never overlap"""
+        share = len(range(start, end, 2)) // self.workers
+        first = start + 2 * share * self.index
+        last = end if self.index == self.workers - 1 else first + 2 * share
+        return first, last
+
+    def publish_calls(self, count):
+        self.calls[self.index] = count
+
+    def total_calls(self):
+        return sum(self.calls)
+
+
+class ForwardProtocol(asyncio.DatagramProtocol):
+    """Receives datagrams other workers forwarded to us as the Call-ID owner"""
+
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, _):
+        header, _, payload = data.partition(b'\n')
+        host, port, local = header.decode().split(' ')
+        self.server.receive_udp(payload, (host, int(port)), None if local == '-' else local)
+
+
+# Largest message accepted on a TCP/TLS connection; anything bigger closes the connection
+MAX_STREAM_MESSAGE = 65536
+# Kernel receive buffer for the UDP socket, so INVITE bursts queue instead of dropping
+# while the loop is busy (Linux caps it at net.core.rmem_max)
+UDP_RECEIVE_BUFFER = 1 << 20
+# Datagrams read per readiness callback before other loop work gets a turn
+UDP_READ_BATCH = 64
+MAX_DATAGRAM = 65535
+
+# Listening on one of these means every local address, of both families for '::'
+WILDCARD_HOSTS = ('', '0.0.0.0', '::')
+# Not exported by the socket module before Python 3.13; the value is the Linux one
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8 if sys.platform.startswith('linux') else None)
+IPV6_PKTINFO = getattr(socket, 'IPV6_PKTINFO', None)
+IPV6_RECVPKTINFO = getattr(socket, 'IPV6_RECVPKTINFO', None)
+# struct in_pktinfo: interface index, local (routing) address, header destination address
+_IN_PKTINFO = struct.Struct('=I4s4s')
+# struct in6_pktinfo: destination address, interface index
+_IN6_PKTINFO = struct.Struct('=16sI')
+_PKTINFO_BUFFER = socket.CMSG_SPACE(max(_IN_PKTINFO.size, _IN6_PKTINFO.size))
+# Per-peer results of the routing-table lookup, used when a datagram carries no destination
+ROUTE_CACHE_TTL = 60.0
+ROUTE_CACHE_SIZE = 4096
+
+
+def address_family(address):
+    """AF_INET6 for an IPv6 literal, AF_INET for anything else"""
+    return socket.AF_INET6 if ':' in address else socket.AF_INET
+
+
+def uri_host(address):
+    """Host part of a SIP URI or Via for an address; IPv6 literals are bracketed (RFC 3261 section 25.1)"""
+    return f"[{address}]" if ':' in address else address
+
+
+def enable_pktinfo(sock):
+    """Ask the kernel to report the destination address of every datagram; False if unsupported"""
+    try:
+        if sock.family == socket.AF_INET6 and IPV6_RECVPKTINFO is not None:
+            sock.setsockopt(socket.IPPROTO_IPV6, IPV6_RECVPKTINFO, 1)
+        elif sock.family == socket.AF_INET and IP_PKTINFO is not None:
+            sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        else:
+            return False
+    except OSError:
+        return False
+    return True
+
+
+def pktinfo_address(ancdata):
+    """Destination address of a received datagram from its IP_PKTINFO/IPV6_PKTINFO control message"""
+    for level, kind, data in ancdata:
+        if level == socket.IPPROTO_IP and kind == IP_PKTINFO and len(data) >= _IN_PKTINFO.size:
+            address = ipaddress.IPv4Address(_IN_PKTINFO.unpack_from(data)[2])
+        elif level == socket.IPPROTO_IPV6 and kind == IPV6_PKTINFO and len(data) >= _IN6_PKTINFO.size:
+            address = ipaddress.IPv6Address(_IN6_PKTINFO.unpack_from(data)[0])
+        else:
+            continue
+        # A reply cannot come from a broadcast or multicast address
+        if address.is_multicast or str(address) == '255.255.255.255':
+            return None
+        return str(address)
+    return None
+
+
+class UDPEndpoint:
+    """The UDP listening socket as seen from one local address
+
+    Replies sent through it leave from the address the request was sent to,
+    which a wildcard-bound socket on a multi-homed host would otherwise leave
+    to the routing table, and phones drop answers from an address they did
+    not send to.
+    """
+
+    def __init__(self, sock, local=None):
+        self.sock = sock
+        self.local = local
+        self._control = []
+        if local is not None:
+            if sock.family == socket.AF_INET6 and IPV6_PKTINFO is not None:
+                info = _IN6_PKTINFO.pack(socket.inet_pton(socket.AF_INET6, local), 0)
+                self._control = [(socket.IPPROTO_IPV6, IPV6_PKTINFO, info)]
+            elif sock.family == socket.AF_INET and IP_PKTINFO is not None:
+                info = _IN_PKTINFO.pack(0, socket.inet_aton(local), bytes(4))
+                self._control = [(socket.IPPROTO_IP, IP_PKTINFO, info)]
+
+    def sendto(self, data, addr):
+        try:
+            if self._control:
+                self.sock.sendmsg([data], self._control, 0, addr)
+            else:
+                self.sock.sendto(data, addr)
+        except BlockingIOError:
+            # Send buffer full: lost like any datagram; retransmission covers requests and responses
+            pass
+
+
+class UDPListener:
+    """Reads SIP datagrams with recvmsg(), so each one arrives with the local address it was sent to"""
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.pktinfo = enable_pktinfo(sock)
+
+    def read(self):
+        sock = self.sock
+        for _ in range(UDP_READ_BATCH):
+            try:
+                data, ancdata, _, addr = sock.recvmsg(MAX_DATAGRAM, _PKTINFO_BUFFER)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.server.log(f"ERROR in packet reception: {e}", logging.WARNING)
+                return
+            self.server.receive_udp(data, addr, pktinfo_address(ancdata) if ancdata else None)
+
+
+class RouteCache:
+    """Local address the routing table picks for each peer, cached so lookups are not per packet
+
+    Connecting a UDP socket makes the kernel choose a route and source address
+    without sending anything. Only needed for requests that arrive without a
+    destination address (no IP_PKTINFO, or handed over by another worker).
+    """
+
+    def __init__(self, ttl=ROUTE_CACHE_TTL, size=ROUTE_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._routes = OrderedDict()
+        self.lookups = 0
+
+    def source_for(self, peer):
+        """Local address used to reach a peer, or None if there is no route"""
+        now = time.monotonic()
+        entry = self._routes.get(peer)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        self.lookups += 1
+        try:
+            with socket.socket(address_family(peer), socket.SOCK_DGRAM) as probe:
+                probe.connect((peer, 9))
+                local = probe.getsockname()[0]
+        except OSError:
+            local = None
+        self._routes[peer] = (local, now + self.ttl)
+        self._routes.move_to_end(peer)
+        if len(self._routes) > self.size:
+            self._routes.popitem(last=False)
+        return local
+
+
+class StreamConnections:
+    """Open connections of one TCP or TLS listener, keyed by peer address
+
+    Stands in for the UDP transport wherever the server calls sendto(), so
+    responses and our own BYEs reuse whichever connection the peer has open
+    instead of opening a new one for every message.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._by_peer = {}
+
+    def __len__(self):
+        return len(self._by_peer)
+
+    def add(self, peer, transport):
+        self._by_peer[peer] = transport
+
+    def remove(self, peer, transport):
+        if self._by_peer.get(peer) is transport:
+            del self._by_peer[peer]
+
+    def sendto(self, data, addr):
+        transport = self._by_peer.get(addr)
+        if transport is None or transport.is_closing():
+            raise ConnectionError(f"no open {self.name} connection to {addr[0]}:{addr[1]}")
+        transport.write(data)
+
+    def close(self):
+        for transport in list(self._by_peer.values()):
+            transport.close()
+
+
+class SIPStreamProtocol(asyncio.Protocol):
+    """One TCP or TLS connection; splits the byte stream into messages by Content-Length"""
+
+    def __init__(self, server, connections):
+        self.server = server
+        self.connections = connections
+        self.transport = None
+        self.peer = None
+        self.local = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')[:2]
+        self.local = transport.get_extra_info('sockname')[0]
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            # Let the kernel find peers that vanished without closing the connection
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.connections.add(self.peer, transport)
+        self.server.log(f"{self.connections.name} connection from {self.peer[0]}:{self.peer[1]}", logging.DEBUG)
+
+    def connection_lost(self, exc):
+        self.connections.remove(self.peer, self.transport)
+        self.server.log(f"{self.connections.name} connection from {self.peer[0]}:{self.peer[1]} closed",
+                        logging.DEBUG)
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        while buffer:
+            if buffer[:2] == b'\r\n':
+                # RFC 5626 keepalive: a double-CRLF ping gets a single-CRLF pong
+                if buffer[:4] == b'\r\n\r\n':
+                    del buffer[:4]
+                    self.transport.write(b'\r\n')
+                elif len(buffer) < 4:
+                    break
+                else:
+                    del buffer[:2]
+                continue
+
+            header_end = buffer.find(b'\r\n\r\n')
+            if header_end < 0:
+                if len(buffer) > MAX_STREAM_MESSAGE:
+                    self.drop("header block too large")
+                break
+            # Content-Length is mandatory on streams (RFC 3261 18.3); without it there is no body
+            match = _CONTENT_LENGTH_RE.search(buffer, 0, header_end)
+            end = header_end + 4 + (int(match.group(1)) if match else 0)
+            if end > MAX_STREAM_MESSAGE:
+                self.drop(f"{end}-byte message")
+                break
+            if len(buffer) < end:
+                break
+            message = bytes(buffer[:end])
+            del buffer[:end]
+            self.server.datagram_received(self.connections, message, self.peer, self.local)
+
+    def drop(self, reason):
+        self.server.log(f"Closing {self.connections.name} connection from {self.peer[0]}:{self.peer[1]}: "
+                        f"{reason}", logging.WARNING)
+        self.buffer.clear()
+        self.transport.close()
+
+
 class SimpleSIPServer:
-    def __init__(self, host='0.0.0.0', port=5060, audio_file='/app/sounds/music.wav'):
+    def __init__(self, host='::', port=5060, audio_file='/app/sounds/music.wav', cache_dir=None,
+                 answer_delay=1.0, max_workers=4, rtp_port_start=10000, rtp_port_end=10100,
+                 session_expires=1800, min_se=90, max_call_duration=7200, reaper_interval=1.0,
+                 metrics_host='127.0.0.1', metrics_port=9090, log_level='INFO', log_format='text',
+                 workers=1, playlists=None, playlist_file=None, frame_cache_bytes=64 << 20,
+                 watch_interval=2.0, codecs=('PCMU', 'PCMA'), max_calls=0, max_cpu=0.9,
+                 max_bandwidth=0, retry_after=30, tcp_port=None, tls_port=None, tls_cert=None,
+                 tls_key=None, rtcp_timeout=30, journal_file=None, advertise_address=None):
+        self.logger = setup_logging(log_level, log_format)
+        self.log_level = log_level
+        self.log_format = log_format
+        self.workers = workers
+        self.cluster = None
+        # '::' listens on every IPv4 and IPv6 address, '0.0.0.0' on every IPv4 one
         self.host = host
         self.port = port
+        # Address for Contact/Via/SDP when phones reach us through NAT (e.g. the Docker host's);
+        # otherwise each request is answered with the address it was sent to
+        self.advertise_address = advertise_address
+        self.routes = RouteCache()
+        # Listening UDP socket per address family, and its per-local-address views
+        self.udp_sockets = {}
+        self._udp_endpoints = {}
+        self.listen_addresses = []
+        # Stream listeners default to the UDP port (TCP) and the next one up (TLS); 0 disables.
+        # Worker mode has none: only UDP requests are forwarded to the worker owning the
+        # Call-ID, so a dialog over a stream could land its requests in the wrong worker
+        if workers > 1 and (tcp_port or tls_cert):
+            raise ValueError("SIP over TCP/TLS is not supported with more than one worker")
+        self.tcp_port = (0 if workers > 1 else port) if tcp_port is None else tcp_port
+        self.tls_port = port + 1 if tls_port is None else tls_port
+        self.tls_cert = tls_cert
+        self.tls_key = tls_key
+        self.stream_connections = {}
+        # (advertised address, transport) -> Contact URI, and Contact URI -> bodiless response tail
+        self._contacts = {}
+        self._response_tails = {}
         self.audio_file = audio_file
+        self.cache_dir = cache_dir
+        self.answer_delay = answer_delay
+        self.max_workers = max_workers
+        self.loop = None
+        self.transactions = None
+        self.templates = ResponseTemplates(host, self.local_contact, self.generate_tag())
+        self.packet_count = 0
+        self._shutdown = None
+        self.playlist_file = playlist_file
+        self._base_playlists = playlists
+        self.playlists, settings = self.read_config()
+        self.frame_cache = FrameCache(cache_dir or os.path.join(os.path.dirname(audio_file), 'cache'),
+                                      frame_cache_bytes, self.log)
+        # (playlist name, encoding) -> MediaBroadcaster, only while someone is listening
+        self.queues = {}
+        # Counters of broadcasters that have been stopped, so totals never go backwards
+        self._retired_media = dict.fromkeys(('packets_sent', 'late_frames', 'dropped_frames',
+                                             'underrun_frames'), 0)
+        unknown = [name for name in codecs if name not in CODECS]
+        if unknown:
+            raise ValueError(f"Unsupported codecs: {', '.join(unknown)} (available: {', '.join(CODECS)})")
+        # Enabled codecs, in the order offered when the INVITE carries no SDP. G722 is
+        # opt-in: its pure-Python encoder runs at only a few times realtime per track
+        self.codecs = tuple(codecs)
+        self.rtp_port_range = (rtp_port_start, rtp_port_end)
+        self.port_pool = RTPPortPool(rtp_port_start, rtp_port_end)
         self.active_calls = {}
+        self.session_expires = session_expires
+        self.min_se = min_se
+        self.max_call_duration = max_call_duration
+        # Seconds of RTCP silence, from a phone that has been sending it, before we hang up; 0 disables
+        self.rtcp_timeout = rtcp_timeout
+        self.watch_interval = watch_interval
+        self._watch_state = None
+        self._watch_pending = None
+        self._reloading = False
+        self._reload_again = False
+        self.reaper_interval = reaper_interval
+        self.call_timers = CallTimers()
+        self.journal_file = journal_file
+        self.journal = None
+        self.admission = AdmissionControl(max_calls, max_cpu, max_bandwidth, retry_after)
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self._received_at = None
+        self.metrics = self.create_metrics()
+        self.apply_settings(settings)
 
-    def log(self, message):
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        print(f"[{timestamp}] {message}")
+    def create_metrics(self):
+        """Register the server's metrics; gauges read live state only when scraped"""
+        metrics = Metrics()
+        metrics.counter('moh_sip_requests_total', "SIP requests received by method")
+        metrics.counter('moh_sip_responses_total', "SIP responses sent by status code")
+        metrics.counter('moh_admission_rejected_total', "INVITEs answered 503 by the limit they hit")
+        self.response_latency = metrics.histogram(
+            'moh_sip_response_latency_seconds', "Time from datagram receipt to the first response sent",
+            LATENCY_BUCKETS)
+        self.tick_lateness = metrics.histogram(
+            'moh_rtp_tick_lateness_seconds', "How late each 20 ms media tick started", LATENESS_BUCKETS)
+        metrics.counter('moh_rtcp_reports_received_total', "RTCP reception reports about our streams")
+        self.rtcp_loss = metrics.histogram(
+            'moh_rtcp_fraction_lost', "Fraction of our RTP lost per interval, as reported by the phones",
+            RTCP_LOSS_BUCKETS)
+        self.rtcp_jitter = metrics.histogram(
+            'moh_rtcp_jitter_seconds', "Interarrival jitter of our RTP, as reported by the phones",
+            RTCP_JITTER_BUCKETS)
+        self.rtcp_rtt = metrics.histogram(
+            'moh_rtcp_round_trip_seconds', "Round trip time derived from RTCP reports", RTCP_RTT_BUCKETS)
+        metrics.callback('moh_sip_packets_received_total', 'counter', "SIP messages received over UDP, TCP and TLS",
+                         lambda: self.packet_count)
+        metrics.callback('moh_active_calls', 'gauge', "Calls currently on hold",
+                         lambda: len(self.active_calls))
+        metrics.callback('moh_cluster_active_calls', 'gauge', "Calls on hold across all worker processes",
+                         lambda: self.cluster.total_calls() if self.cluster else len(self.active_calls))
+        metrics.callback('moh_sip_transactions', 'gauge', "Live server transactions",
+                         lambda: len(self.transactions) if self.transactions else 0)
+        metrics.callback('moh_process_cpu_ratio', 'gauge', "Share of one core used by this process",
+                         lambda: self.admission.cpu)
+        metrics.callback('moh_rtcp_reporting_calls', 'gauge', "Held calls whose phone sends RTCP reports",
+                         lambda: sum(1 for call in list(self.active_calls.values())
+                                     if call.rtcp is not None and call.rtcp.reports))
+        metrics.callback('moh_rtp_ports_in_use', 'gauge', "RTP ports allocated to calls",
+                         lambda: len(self.port_pool))
+        metrics.callback('moh_rtp_ports_total', 'gauge', "Size of the RTP port pool",
+                         lambda: self.port_pool.size)
+        metrics.callback('moh_rtp_packets_sent_total', 'counter', "RTP packets sent to all calls",
+                         lambda: self.media_stat('packets_sent'))
+        metrics.callback('moh_rtp_late_frames_total', 'counter',
+                         f"Media ticks that started more than {LATE_FRAME_THRESHOLD * 1000:.0f} ms late",
+                         lambda: self.media_stat('late_frames'))
+        metrics.callback('moh_rtp_dropped_frames_total', 'counter',
+                         "Frames skipped because the media clock fell too far behind",
+                         lambda: self.media_stat('dropped_frames'))
+        metrics.callback('moh_rtp_underrun_frames_total', 'counter',
+                         "Frames not sent because playback caught up with a track still being encoded",
+                         lambda: self.media_stat('underrun_frames'))
+        metrics.callback('moh_rtp_send_jitter_seconds', 'gauge',
+                         "Smoothed deviation of the media tick interval from 20 ms",
+                         lambda: max((broadcast.jitter for broadcast in list(self.queues.values())), default=0))
+        metrics.callback('moh_playlists_playing', 'gauge',
+                         "Playlist broadcasts (one per codec) with at least one listener",
+                         lambda: len(self.queues))
+        metrics.callback('moh_frame_cache_entries', 'gauge', "Encoded tracks held in the frame cache",
+                         lambda: len(self.frame_cache))
+        metrics.callback('moh_frame_cache_hits_total', 'counter', "Track lookups served from the frame cache",
+                         lambda: self.frame_cache.hits)
+        metrics.callback('moh_frame_cache_misses_total', 'counter', "Track lookups that had to load or encode",
+                         lambda: self.frame_cache.misses)
+        metrics.callback('moh_frame_cache_ingesting', 'gauge', "Tracks still being encoded in the background",
+                         lambda: self.frame_cache.ingesting)
+        return metrics
+
+    def media_stat(self, name):
+        """Sum a broadcaster counter over live and stopped playlists"""
+        return self._retired_media[name] + sum(getattr(broadcast, name) for broadcast in list(self.queues.values()))
+
+    def log(self, message, level=logging.INFO):
+        self.logger.log(level, message)
 
     def generate_call_id(self):
         return f"{random.randint(100000, 999999)}@moh-server"
 
     def generate_tag(self):
-        return f"tag-{random.randint(10000, 99999)}"
+        # RFC 3261 section 19.3 asks for at least 32 random bits
+        return f"tag-{random.getrandbits(32):08x}"
 
     def send_response(self, sock, addr, response):
         try:
-            sock.sendto(response.encode('utf-8'), addr)
-            self.log(f"Sent response to {addr[0]}:{addr[1]}")
+            sock.sendto(response, addr)
+            if self._received_at is not None:
+                self.response_latency.observe(time.perf_counter() - self._received_at)
+                self._received_at = None
+            self.metrics.inc('moh_sip_responses_total', f'code="{response[8:11].decode()}"')
+            self.log(f"Sent response to {addr[0]}:{addr[1]}", logging.DEBUG)
         except Exception as e:
-            self.log(f"Error sending response: {e}")
+            self.log(f"Error sending response: {e}", logging.ERROR)
 
-    def create_sip_response(self, request_lines, status_code, status_text):
-        """Create SIP response based on received request"""
-        response_lines = [f"SIP/2.0 {status_code} {status_text}"]
+    def copy_dialog_headers(self, request, to_tag=None):
+        """Header lines a response copies from its request, as bytes slices"""
+        # Add tag to To header if it's missing
+        return request.dialog_lines(f";tag={to_tag or self.generate_tag()}".encode())
+
+    def transport_port(self, transport):
+        """Our listening port for a Via transport name"""
+        return {'TCP': self.tcp_port, 'TLS': self.tls_port}.get(transport) or self.port
 
+    def contact(self, request):
+        """Contact URI on the transport the request arrived over, so in-dialog requests stay on it"""
+        return self.local_contact(request.advertised or self.host, request.transport)
+
+    def local_contact(self, address, transport):
+        """Contact URI for our address as advertised to a peer and a transport name"""
+        key = (address, transport)
+        contact = self._contacts.get(key)
+        if contact is None:
+            host = uri_host(key[0])
+            if transport in ('TCP', 'TLS'):
+                contact = f"<sip:moh@{host}:{self.transport_port(transport)};transport={transport.lower()}>"
+            else:
+                contact = f"<sip:moh@{host}:{self.port}>"
+            self._contacts[key] = contact
+        return contact
+
+    def response_tail(self, request):
+        """Contact, Content-Length and User-Agent lines that end a response without a body"""
+        contact = self.contact(request)
+        tail = self._response_tails.get(contact)
+        if tail is None:
+            tail = self._response_tails[contact] = (f"\r\nContact: {contact}\r\n"
+                                                    f"Content-Length: 0\r\n"
+                                                    f"User-Agent: MoH-Server/1.0\r\n\r\n").encode()
+        return tail
+
+    def advertised_address(self, local, peer):
+        """Our address for a peer: the configured one, else the one the peer sent to, else the route's"""
+        if self.advertise_address:
+            return self.advertise_address
+        if local and local not in WILDCARD_HOSTS:
+            return local
+        if self.host not in WILDCARD_HOSTS:
+            return self.host
+        return self.routes.source_for(peer) or self.host
+
+    def udp_endpoint(self, family, local=None):
+        """The UDP socket of a family, sending from a given local address"""
+        key = (family, local)
+        endpoint = self._udp_endpoints.get(key)
+        if endpoint is None:
+            endpoint = self._udp_endpoints[key] = UDPEndpoint(self.udp_sockets[family], local)
+        return endpoint
+
+    def receive_udp(self, data, addr, local=None):
+        """A datagram from a listening socket or another worker, with the address it was sent to"""
+        family = address_family(addr[0])
+        if family not in self.udp_sockets:
+            return
+        self.datagram_received(self.udp_endpoint(family, local), data, addr, local)
+
+    def media_host(self, target):
+        """Local address to bind a call's RTP/RTCP sockets to for a media target"""
+        family = address_family(target[0])
+        if self.host not in WILDCARD_HOSTS and address_family(self.host) == family:
+            return self.host
+        return '::' if family == socket.AF_INET6 else '0.0.0.0'
+
+    def create_sip_response(self, request, status_code, status_text, to_tag=None, extra_headers=()):
+        """Create SIP response based on received request"""
         # Copy necessary headers from request
-        for line in request_lines[1:]:
-            if line.startswith(('Via:', 'From:', 'Call-ID:', 'CSeq:')):
-                response_lines.append(line)
-            elif line.startswith('To:'):
-                # Add tag to To header if it's missing
-                if 'tag=' not in line:
-                    response_lines.append(f"{line};tag={self.generate_tag()}")
-                else:
-                    response_lines.append(line)
+        response_lines = self.copy_dialog_headers(request, to_tag)
+        response_lines.insert(0, f"SIP/2.0 {status_code} {status_text}".encode())
+        if extra_headers:
+            response_lines.extend(header.encode() for header in extra_headers)
 
         # Add server headers
-        response_lines.extend([
-            f"Contact: <sip:moh@{self.host}:{self.port}>",
-            "Content-Length: 0",
-            "User-Agent: MoH-Server/1.0",
-            ""
-        ])
+        return b'\r\n'.join(response_lines) + self.response_tail(request)
 
-        return '\r\n'.join(response_lines)
-
-    def create_sip_ok_with_sdp(self, request_lines, audio_port):
+    def create_sip_ok_with_sdp(self, request, sdp_content, to_tag=None, extra_headers=()):
         """Create 200 OK response with SDP for audio streaming"""
-        response_lines = [f"SIP/2.0 200 OK"]
-
         # Copy necessary headers from request
-        for line in request_lines[1:]:
-            if line.startswith(('Via:', 'From:', 'Call-ID:', 'CSeq:')):
-                response_lines.append(line)
-            elif line.startswith('To:'):
-                if 'tag=' not in line:
-                    response_lines.append(f"{line};tag={self.generate_tag()}")
-                else:
-                    response_lines.append(line)
-
-        # SDP content
-        sdp_content = f"""v=0
-o=moh-server 123456 123456 IN IP4 {self.host}
-s=Music On Hold
-c=IN IP4 {self.host}
-t=0 0
-m=audio {audio_port} RTP/AVP 0
-a=rtpmap:0 PCMU/8000
-a=sendonly
-"""
+        response_lines = self.copy_dialog_headers(request, to_tag)
+        response_lines.insert(0, b"SIP/2.0 200 OK")
+        if extra_headers:
+            response_lines.extend(header.encode() for header in extra_headers)
 
         # Add headers
-        response_lines.extend([
-            f"Contact: <sip:moh@{self.host}:{self.port}>",
-            f"Content-Type: application/sdp",
-            f"Content-Length: {len(sdp_content)}",
+        sdp_content = sdp_content.encode()
+        return b'\r\n'.join(response_lines) + (f"\r\nContact: {self.contact(request)}\r\n"
+                                                 f"Content-Type: application/sdp\r\n"
+                                                 f"Content-Length: {len(sdp_content)}\r\n"
+                                                 f"User-Agent: MoH-Server/1.0\r\n\r\n").encode() + sdp_content
+
+    def read_config(self):
+        """Playlists and settings from the constructor and the configuration file"""
+        playlists = dict(self._base_playlists or {})
+        settings = {}
+        if self.playlist_file:
+            file_playlists, settings = load_config_file(self.playlist_file)
+            playlists.update(file_playlists)
+        playlists.setdefault(DEFAULT_PLAYLIST, [self.audio_file])
+        playlists = {str(user): [tracks] if isinstance(tracks, str) else list(tracks)
+                     for user, tracks in playlists.items()}
+        return playlists, settings
+
+    def apply_settings(self, settings):
+        """Apply settings that can change without a restart"""
+        for name in ('answer_delay', 'session_expires', 'min_se', 'max_call_duration', 'rtcp_timeout'):
+            if name in settings:
+                setattr(self, name, settings[name])
+        for name in ('max_calls', 'max_cpu', 'max_bandwidth', 'retry_after'):
+            if name in settings:
+                setattr(self.admission, name, settings[name])
+        if 'log_level' in settings:
+            self.log_level = settings['log_level']
+            self.logger.setLevel(self.log_level.upper())
+        if 'rtp_port_start' in settings or 'rtp_port_end' in settings:
+            self.rtp_port_range = (settings.get('rtp_port_start', self.rtp_port_range[0]),
+                                   settings.get('rtp_port_end', self.rtp_port_range[1]))
+            port_range = self.cluster.port_range(*self.rtp_port_range) if self.cluster else self.rtp_port_range
+            if port_range != (self.port_pool.start, self.port_pool.end):
+                self.port_pool.resize(*port_range)
+                self.log(f"RTP port range is now {self.port_pool.start}-{self.port_pool.end - 1}")
+
+    def select_playlist(self, request):
+        """Playlist for the Request-URI user, falling back to the default"""
+        user = request_user(request)
+        return user if user in self.playlists else DEFAULT_PLAYLIST
+
+    def load_audio(self, playlists=None):
+        """Make every configured track playable in every codec; uncached tracks finish encoding in the background"""
+        keep = set()
+        for name, sources in (playlists or self.playlists).items():
+            for source in sources:
+                if not os.path.exists(source):
+                    self.log(f"Audio file not found for playlist {name}: {source}", logging.ERROR)
+                    continue
+                for encoding in self.codecs:
+                    try:
+                        started = time.monotonic()
+                        frames, cache_hit = self.frame_cache.get(source, encoding)
+                        keep.add(self.frame_cache.cache_path(source, encoding))
+                        if frames.complete:
+                            self.log(f"{'Reused cached' if cache_hit else 'Encoded'} {len(frames)} {encoding} frames "
+                                     f"({len(frames) * FRAME_INTERVAL:.1f}s) for {name}: {source} "
+                                     f"in {time.monotonic() - started:.2f}s")
+                        else:
+                            self.log(f"First {len(frames) * FRAME_INTERVAL:.1f}s of {encoding} audio ready for "
+                                     f"{name}: {source} in {time.monotonic() - started:.2f}s, "
+                                     f"encoding the rest in the background")
+                    except Exception as e:
+                        self.log(f"Error loading audio file {source} as {encoding}: {e}", logging.ERROR)
+        prune_frame_cache(self.frame_cache.cache_dir, keep)
+
+    def playlist_key(self, name, encoding='PCMU'):
+        """Cache files a playlist would play, which change with its track list or any track's content"""
+        key = []
+        for source in self.playlists.get(name, self.playlists[DEFAULT_PLAYLIST]):
+            try:
+                key.append(self.frame_cache.cache_path(source, encoding))
+            except OSError:
+                key.append(None)
+        return tuple(key)
+
+    def build_playlist(self, name, encoding='PCMU'):
+        """Frames of a playlist from the frame cache; removed playlists fall back to the default"""
+        tracks = []
+        for source in self.playlists.get(name, self.playlists[DEFAULT_PLAYLIST]):
+            try:
+                tracks.append(self.frame_cache.get(source, encoding)[0])
+            except Exception as e:
+                self.log(f"Error loading audio file {source} as {encoding}: {e}", logging.ERROR)
+        playlist = Playlist(tracks, self.playlist_key(name, encoding))
+        if not len(playlist):
+            self.log(f"Playlist {name} has no playable {encoding} audio", logging.ERROR)
+            return None
+        return playlist
+
+    async def open_playlist(self, name, encoding='PCMU'):
+        """Broadcaster for a playlist in one codec, started when it gets its first listener
+
+        Building the playlist may wait for a track's first seconds to be encoded, so it
+        runs in the executor rather than on the event loop.
+        """
+        key = (name, encoding)
+        broadcaster = self.queues.get(key)
+        if broadcaster is None:
+            playlist = await self.loop.run_in_executor(None, self.build_playlist, name, encoding)
+            # Another call may have opened it while this one waited
+            broadcaster = self.queues.get(key)
+            if broadcaster is None and playlist is not None:
+                broadcaster = self.queues[key] = MediaBroadcaster(playlist, self.tick_lateness).start()
+        return broadcaster
+
+    def request_reload(self):
+        """SIGHUP or a changed file: reload configuration and audio without dropping calls"""
+        if self._reloading:
+            self._reload_again = True
+            return
+        self._reloading = True
+        self.loop.create_task(self.reload())
+
+    async def reload(self):
+        """Re-read the configuration and encode new audio off the loop, then swap it in"""
+        # Files as they were before reading them, so a write during the reload still counts
+        # as a change, and a file that failed to load is not retried until it changes again
+        state = self.watched_file_state()
+        try:
+            self.log("Reloading configuration and audio")
+            playlists, settings = await self.loop.run_in_executor(None, self.read_config)
+            await self.loop.run_in_executor(None, self.load_audio, playlists)
+            self.playlists = playlists
+            self.apply_settings(settings)
+            # Playing queues whose audio changed switch at their next frame boundary; the
+            # rest play on undisturbed, and idle ones load on demand
+            swapped = 0
+            for (name, encoding), broadcaster in list(self.queues.items()):
+                # Hashing or encoding a track that load_audio did not leave cached stays off the loop
+                key = await self.loop.run_in_executor(None, self.playlist_key, name, encoding)
+                if broadcaster.next_frames.key == key:
+                    continue
+                playlist = await self.loop.run_in_executor(None, self.build_playlist, name, encoding)
+                if playlist is not None:
+                    broadcaster.swap(playlist)
+                    swapped += 1
+            # Tracks new to this configuration are watched from now on
+            state = {path: state.get(path, stat) for path, stat in self.watched_file_state().items()}
+            self.log(f"Reload complete ({len(self.playlists)} playlists, {len(self.queues)} playing, "
+                     f"{swapped} switched to new audio)")
+        except Exception as e:
+            self.log(f"Reload failed, keeping the current configuration: {e}", logging.ERROR)
+        finally:
+            self._watch_state = self._watch_pending = state
+            self._reloading = False
+            if self._reload_again:
+                self._reload_again = False
+                self.request_reload()
+
+    def watched_file_state(self):
+        """(mtime, size) of the configuration file and every configured track"""
+        paths = [self.playlist_file] if self.playlist_file else []
+        paths.extend(source for sources in self.playlists.values() for source in sources)
+        state = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                state[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                state[path] = None
+        return state
+
+    def check_for_changes(self):
+        """Poll watched files; reload once a change has been stable for one interval"""
+        try:
+            state = self.watched_file_state()
+            if state == self._watch_state:
+                self._watch_pending = state
+            elif state == self._watch_pending:
+                # Unchanged since the last poll, so the writer has finished
+                self.log("Configuration or audio files changed")
+                self.request_reload()
+            else:
+                self._watch_pending = state
+        finally:
+            self.loop.call_later(self.watch_interval, self.check_for_changes)
+
+    def close_playlist(self, key):
+        """Stop a playlist's clock once nobody is listening, releasing its frames"""
+        broadcaster = self.queues.pop(key, None)
+        if broadcaster is not None:
+            broadcaster.stop()
+            for stat in self._retired_media:
+                self._retired_media[stat] += getattr(broadcaster, stat)
+
+    def start_rtp_stream(self, call, broadcaster, resume=None):
+        """Attach a call to the broadcast of its playlist, continuing a journaled stream if given"""
+        target_ip, target_port = call.media_target
+        call_id = call.call_id
+
+        def on_unreachable(stream):
+            # Runs on the media thread; hand over to the event loop
+            self.loop.call_soon_threadsafe(self.handle_media_unreachable, call_id)
+
+        try:
+            self.log(f"Starting RTP stream to {target_ip}:{target_port}")
+            stream = RTPStream(call.media_target, (self.media_host(call.media_target), call.rtp_port),
+                               call.payload_type, on_unreachable)
+        except Exception as e:
+            self.log(f"Error starting RTP stream: {e}", logging.ERROR)
+            if not len(broadcaster):
+                self.close_playlist((call.playlist, call.encoding))
+            return None
+        if resume and 'rtp' in resume:
+            # Carry on where the old process left off, as if no frame had been missed
+            frames = int((time.time() - resume['saved']) / FRAME_INTERVAL)
+            ssrc, sequence, timestamp = resume['rtp']
+            stream.ssrc = ssrc
+            stream.sequence = (sequence + frames) & 0xFFFF
+            stream.timestamp = (timestamp + frames * FRAME_SAMPLES) & 0xFFFFFFFF
+            if 'position' in resume and not len(broadcaster):
+                broadcaster.position = (resume['position'] + frames) % len(broadcaster.frames)
+        broadcaster.add(call.call_id, stream)
+        self.start_rtcp(call, stream)
+        return stream
+
+    def rtcp_target(self, call):
+        """Where the phone listens for RTCP: its a=rtcp port, else the RTP port + 1"""
+        address, port = call.media_target
+        return (address, call.rtcp_port or port + 1)
+
+    def start_rtcp(self, call, stream):
+        """Open the call's RTCP socket on the RTP port + 1; audio goes on without it if that fails"""
+        try:
+            session = RTCPSession(stream, (self.media_host(call.media_target), call.rtp_port + 1),
+                                  self.rtcp_target(call), f"moh@{call.local_address or self.host}")
+        except OSError as e:
+            self.log(f"RTCP disabled for call {call.call_id}: {e}", logging.WARNING)
+            return
+        self.loop.add_reader(session.sock.fileno(), self.receive_rtcp, call)
+        call.rtcp = session
+
+    def receive_rtcp(self, call):
+        """Read the phone's reports and feed the latest reception statistics into the metrics"""
+        session = call.rtcp
+        if session is None or not session.receive():
+            return
+        self.metrics.inc('moh_rtcp_reports_received_total')
+        if call.stream is not None:
+            # The phone is evidently still there, whatever ICMP said about its RTP port
+            call.stream.refused = 0
+        self.rtcp_loss.observe(session.fraction_lost)
+        self.rtcp_jitter.observe(session.jitter)
+        if session.rtt is not None:
+            self.rtcp_rtt.observe(session.rtt)
+
+    def stop_rtcp(self, call, shutdown=False):
+        """Send RTCP BYE, close the socket and log what the phone reported over the call
+
+        At shutdown no BYE is sent: the journaled call is resumed with the same SSRC.
+        """
+        session, call.rtcp = call.rtcp, None
+        if session is None:
+            return
+        # A no-op once the loop has closed (calls cleaned up at shutdown)
+        self.loop.remove_reader(session.sock.fileno())
+        session.close(bye=not shutdown)
+        if session.reports:
+            rtt = f", RTT {session.rtt * 1000:.0f} ms" if session.rtt is not None else ""
+            self.log(f"Call {call.call_id} to {call.media_target[0]}: {session.cumulative_lost} packets lost, "
+                     f"last interval {session.fraction_lost:.1%}, jitter {session.jitter * 1000:.1f} ms{rtt}")
+
+    def service_rtcp(self, now):
+        """Send due Sender Reports and hang up calls whose phone stopped sending RTCP"""
+        for call in list(self.active_calls.values()):
+            session = call.rtcp
+            if session is None:
+                continue
+            # Only phones that have sent RTCP are expected to keep sending it
+            if (self.rtcp_timeout and session.last_received is not None
+                    and now - session.last_received > self.rtcp_timeout):
+                self.hangup(call, f"no RTCP for {self.rtcp_timeout:.0f}s")
+            elif now >= session.next_report:
+                session.send_report()
+
+    def stop_rtp_stream(self, call, shutdown=False):
+        """Detach a call from its broadcast and release its socket"""
+        key = (call.playlist, call.encoding)
+        broadcaster = self.queues.get(key)
+        stream = broadcaster.remove(call.call_id) if broadcaster is not None else None
+        self.stop_rtcp(call, shutdown)
+        if stream:
+            stream.close()
+        if broadcaster is not None and not len(broadcaster):
+            self.close_playlist(key)
+
+    def end_call(self, call_id, shutdown=False):
+        """Stop a call's stream and return its RTP port to the pool
+
+        shutdown: the server is stopping, not the call; it stays resumable.
+        """
+        call = self.active_calls.pop(call_id, None)
+        if call is None:
+            return False
+        if self.journal:
+            self.journal.end(call_id)
+        # Invalidates any pending heap entries for this call
+        call.deadlines.clear()
+        try:
+            self.stop_rtp_stream(call, shutdown)
+        finally:
+            self.port_pool.release(call.rtp_port)
+            if self.cluster:
+                self.cluster.publish_calls(len(self.active_calls))
+        return True
+
+    def create_bye(self, call):
+        """Create an in-dialog BYE for a call we are ending ourselves"""
+        return self.create_request(call, 'BYE')
+
+    def create_request(self, call, method, extra_headers=(), body='', cseq=None, branch=None):
+        """Create an in-dialog request; a new CSeq is taken unless one is given (ACK)"""
+        if cseq is None:
+            call.local_cseq += 1
+            cseq = call.local_cseq
+        request_lines = [
+            f"{method} {call.remote_target} SIP/2.0",
+            f"Via: SIP/2.0/{call.transport} {uri_host(call.local_address or self.host)}:"
+            f"{self.transport_port(call.transport)};"
+            f"branch={branch or f'z9hG4bK{random.getrandbits(48):012x}'};rport",
+            "Max-Forwards: 70",
+        ]
+        request_lines.extend(f"Route: {route}" for route in call.route_set)
+        request_lines.extend([
+            f"From: {call.local_party}",
+            f"To: {call.remote_party}",
+            f"Call-ID: {call.call_id}",
+            f"CSeq: {cseq} {method}",
+        ])
+        if method in ('INVITE', 'UPDATE'):
+            # Target refresh requests carry our Contact (RFC 3261 section 12.2.1.1, RFC 3311)
+            request_lines.append(f"Contact: {self.local_contact(call.local_address or self.host, call.transport)}")
+        request_lines.extend(extra_headers)
+        body = body.encode()
+        if body:
+            request_lines.append("Content-Type: application/sdp")
+        request_lines.extend([
+            f"Content-Length: {len(body)}",
             "User-Agent: MoH-Server/1.0",
             "",
-            sdp_content
+            "",
         ])
+        return '\r\n'.join(request_lines).encode() + body
+
+    def hangup(self, call, reason):
+        """End a call from our side: send BYE to the caller and free its resources"""
+        self.log(f"Ending call {call.call_id}: {reason}")
+        if call.sock and call.remote_target:
+            try:
+                call.sock.sendto(self.create_bye(call), call.remote_addr)
+            except Exception as e:
+                self.log(f"Error sending BYE: {e}", logging.ERROR)
+        self.transactions.end_dialog(call.call_id)
+        if self.end_call(call.call_id):
+            self.log(f"Stopped Music On Hold for call {call.call_id}")
 
-        return '\r\n'.join(response_lines)
+    def negotiate_session_timer(self, request, call):
+        """RFC 4028 negotiation; returns response headers, or None if the interval is too small"""
+        supported = header_tokens(request, 'supported', 'require')
+        value = request.get('session-expires')
+        if not value and 'timer' not in supported:
+            return []
 
-    def start_rtp_stream(self, target_ip, target_port, audio_file):
-        """Start RTP audio stream using ffmpeg"""
+        interval, refresher = session_expires(value)
+        if interval is None:
+            interval = self.session_expires
+        elif interval < self.min_se:
+            return None
         try:
-            cmd = [
-                'ffmpeg',
-                '-re',  # Read input at native frame rate
-                '-stream_loop', '-1',  # Loop indefinitely
-                '-i', audio_file,
-                '-acodec', 'pcm_mulaw',
-                '-ar', '8000',
-                '-ac', '1',
-                '-f', 'rtp',
-                f'rtp://{target_ip}:{target_port}'
-            ]
+            interval = max(interval, int((request.get('min-se') or '0').split(';', 1)[0]))
+        except ValueError:
+            pass
 
-            self.log(f"Starting RTP stream to {target_ip}:{target_port}")
-            process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            return process
+        if 'timer' not in supported:
+            # Only the UAC could refresh and it does not support timers; rely on
+            # the hold limit and media liveness instead
+            call.session_interval = None
+            return []
+        call.session_interval = interval
+        if refresher == 'uas':
+            # RFC 4028 section 9: a refresher chosen by the UAC is kept, so we send the refreshes
+            call.refresher = 'uas'
+            return [f"Session-Expires: {interval};refresher=uas", "Require: timer"]
+        call.refresher = 'uac'
+        return [f"Session-Expires: {interval};refresher=uac", "Require: timer"]
+
+    def refresh_session(self, call):
+        """(Re)arm the session timer after the dialog was established or refreshed"""
+        if call.session_interval:
+            # RFC 4028 section 10: end the session slightly before it expires
+            interval = call.session_interval
+            now = time.monotonic()
+            self.call_timers.schedule(call, 'session timer expired', now + interval - min(32, interval / 3))
+            if call.refresher == 'uas':
+                # and refresh it at half the interval when we are the refresher
+                self.call_timers.schedule(call, SESSION_REFRESH_DUE, now + interval / 2)
+                return
+        self.call_timers.cancel(call, SESSION_REFRESH_DUE)
+
+    def send_session_refresh(self, call):
+        """Refresh a session we are the refresher for, repeating until a response arrives"""
+        interval = call.session_interval
+        if not interval or call.refresher != 'uas' or not (call.sock and call.remote_target):
+            return
+        headers = [f"Session-Expires: {interval};refresher=uas", f"Min-SE: {self.min_se}", "Supported: timer"]
+        # A re-INVITE offers the SDP we answered with, unchanged (RFC 4028 section 7.4)
+        body = (call.answer_sdp or '') if call.refresh_method == 'INVITE' else ''
+        request = self.create_request(call, call.refresh_method, headers, body)
+        call.refresh_cseq = call.local_cseq
+        self.log(f"Refreshing session of call {call.call_id} with {call.refresh_method}", logging.DEBUG)
+        try:
+            call.sock.sendto(request, call.remote_addr)
         except Exception as e:
-            self.log(f"Error starting RTP stream: {e}")
-            return None
+            self.log(f"Error sending session refresh: {e}", logging.ERROR)
+        self.call_timers.schedule(call, SESSION_REFRESH_DUE, time.monotonic() + SESSION_REFRESH_RETRY)
+        self.journal_call(call)
+
+    def handle_response(self, addr, response):
+        """Responses to our session refreshes; nothing else we send expects an answer"""
+        call = self.active_calls.get(response.get('call-id'))
+        number, method = response.cseq()
+        if call is None or number is None or method not in ('INVITE', 'UPDATE'):
+            return
+        try:
+            code = int(response.start_line.split(None, 2)[1])
+        except (IndexError, ValueError):
+            return
+        if code < 200:
+            if number == call.refresh_cseq:
+                # Being worked on; give it as long as an INVITE transaction (Timer B) before repeating
+                self.call_timers.schedule(call, SESSION_REFRESH_DUE, time.monotonic() + 32)
+            return
+        if method == 'INVITE':
+            # A 2xx is acknowledged end to end in a new transaction, any other final
+            # response hop by hop in the INVITE's own (RFC 3261 section 17.1.1.3)
+            branch = response.branch() if code >= 300 else None
+            try:
+                call.sock.sendto(self.create_request(call, 'ACK', cseq=number, branch=branch), call.remote_addr)
+            except Exception as e:
+                self.log(f"Error sending ACK: {e}", logging.ERROR)
+        if code < 300:
+            call.remote_target = header_uri(response.get('contact')) or call.remote_target
+            interval, refresher = session_expires(response.get('session-expires'))
+            if interval is not None:
+                call.session_interval = interval
+                call.refresher = refresher or call.refresher
+            self.refresh_session(call)
+            self.journal_call(call)
+        elif number != call.refresh_cseq:
+            # Failure of a refresh that has since been repeated
+            return
+        elif code == 422:
+            try:
+                call.session_interval = max(call.session_interval,
+                                            int((response.get('min-se') or '0').split(';', 1)[0]))
+            except ValueError:
+                pass
+            self.send_session_refresh(call)
+        elif code in (405, 501) and method == 'UPDATE':
+            self.log(f"Phone on call {call.call_id} does not take UPDATE - refreshing with re-INVITE")
+            call.refresh_method = 'INVITE'
+            self.send_session_refresh(call)
+        elif code in (408, 481):
+            # The phone no longer knows the dialog (RFC 3261 section 12.2.1.2)
+            self.hangup(call, f"session refresh answered {code}")
 
-    def handle_invite(self, sock, addr, request_lines):
+    def reap_calls(self):
+        """Periodic sweep that ends calls whose session timer or hold limit ran out"""
+        try:
+            now = time.monotonic()
+            self.admission.sample(self.frame_cache.ingest_cpu)
+            for call, reason in self.call_timers.pop_due(now):
+                if self.active_calls.get(call.call_id) is not call:
+                    continue
+                if reason == SESSION_REFRESH_DUE:
+                    self.send_session_refresh(call)
+                else:
+                    self.hangup(call, reason)
+            self.service_rtcp(now)
+        finally:
+            self.loop.call_later(self.reaper_interval, self.reap_calls)
+
+    def handle_media_unreachable(self, call_id):
+        """The caller's RTP port answers with ICMP unreachable: the phone is gone"""
+        call = self.active_calls.get(call_id)
+        if call:
+            self.hangup(call, "RTP destination unreachable")
+
+    def start_media(self, call, resume=None):
+        """Start sending hold music for an answered call"""
+        if call.direction == 'inactive':
+            self.log(f"Caller does not want to receive audio on call {call.call_id}")
+            return
+        self.loop.create_task(self.open_media(call, resume))
+
+    async def open_media(self, call, resume=None):
+        """Open the call's playlist, then attach the call unless it ended or got a stream meanwhile"""
+        try:
+            broadcaster = await self.open_playlist(call.playlist, call.encoding)
+        except Exception as e:
+            self.log(f"Error opening playlist {call.playlist} as {call.encoding}: {e}", logging.ERROR)
+            return
+        if broadcaster is None or self.active_calls.get(call.call_id) is not call or call.stream is not None:
+            if broadcaster is not None and not len(broadcaster):
+                self.close_playlist((call.playlist, call.encoding))
+            return
+        call.stream = self.start_rtp_stream(call, broadcaster, resume)
+        if call.stream:
+            self.log(f"Started Music On Hold ({call.playlist}, {call.encoding}) for call {call.call_id}")
+            # Journal the RTP state so a restart continues this stream
+            self.journal_call(call)
+
+    def journal_call(self, call):
+        """Queue the call's current state for the journal"""
+        if self.journal is not None:
+            self.journal.record(self.call_snapshot(call))
+
+    def call_snapshot(self, call):
+        """Everything needed to carry a call over a restart, as plain JSON types"""
+        now = time.time()
+        # Deadlines are monotonic; the journal keeps them as wall-clock times
+        offset = now - time.monotonic()
+        snapshot = {
+            'call_id': call.call_id,
+            'rtp_port': call.rtp_port,
+            'remote_addr': call.remote_addr,
+            'media_target': call.media_target,
+            'rtcp_port': call.rtcp_port,
+            'payload_type': call.payload_type,
+            'encoding': call.encoding,
+            'direction': call.direction,
+            'answer_sdp': call.answer_sdp,
+            'playlist': call.playlist,
+            'transport': call.transport,
+            'local_address': call.local_address,
+            'local_party': call.local_party,
+            'remote_party': call.remote_party,
+            'remote_target': call.remote_target,
+            'route_set': call.route_set,
+            'local_cseq': call.local_cseq,
+            'session_interval': call.session_interval,
+            'refresher': call.refresher,
+            'refresh_method': call.refresh_method,
+            'deadlines': {reason: deadline + offset for reason, deadline in call.deadlines.items()},
+            'saved': now,
+        }
+        stream = call.stream
+        if stream is not None:
+            snapshot['rtp'] = [stream.ssrc, stream.sequence, stream.timestamp]
+            broadcaster = self.queues.get((call.playlist, call.encoding))
+            if broadcaster is not None:
+                snapshot['position'] = broadcaster.position
+        return snapshot
+
+    def resume_calls(self):
+        """Open the journal and take back the calls a previous run was holding"""
+        path = f"{self.journal_file}.{self.cluster.index}" if self.cluster else self.journal_file
+        started = time.perf_counter()
+        self.journal = journal = CallJournal(path)
+        try:
+            snapshots = journal.load()
+        except OSError as e:
+            self.log(f"Cannot read call journal {path}: {e}", logging.ERROR)
+            snapshots = {}
+        now = time.time()
+        offset = time.monotonic() - now
+        resumed = expired = 0
+        for snapshot in snapshots.values():
+            call = Call(snapshot['call_id'], snapshot['rtp_port'], tuple(snapshot['remote_addr']))
+            for name in ('rtcp_port', 'payload_type', 'encoding', 'direction', 'answer_sdp', 'playlist',
+                         'transport', 'local_party', 'remote_party', 'remote_target', 'route_set',
+                         'local_cseq', 'session_interval'):
+                setattr(call, name, snapshot[name])
+            # Written before we could be the refresher
+            call.refresher = snapshot.get('refresher', 'uac')
+            call.refresh_method = snapshot.get('refresh_method', 'UPDATE')
+            call.media_target = tuple(snapshot['media_target']) if snapshot['media_target'] else None
+            # Written before addresses were journaled: the route to the caller gives the same answer
+            call.local_address = (snapshot.get('local_address')
+                                  or self.advertised_address(None, call.remote_addr[0]))
+            call.sock = self.stream_connections.get(call.transport)
+            if call.sock is None:
+                family = address_family(call.remote_addr[0])
+                if family not in self.udp_sockets:
+                    self.log(f"Cannot resume call {call.call_id}: not listening for "
+                             f"{'IPv6' if family == socket.AF_INET6 else 'IPv4'}", logging.WARNING)
+                    continue
+                call.sock = self.udp_endpoint(family)
+            due = [reason for reason, deadline in snapshot['deadlines'].items()
+                   if deadline <= now and reason != SESSION_REFRESH_DUE]
+            if due:
+                # Ran out while we were down; a phone still holding would otherwise never hear of it
+                expired += 1
+                self.hangup(call, f"{due[0]} while the server was down")
+                continue
+            if not self.port_pool.claim(call.rtp_port) or call.playlist not in self.playlists:
+                self.hangup(call, "could not resume after restart")
+                continue
+            self.active_calls[call.call_id] = call
+            for reason, deadline in snapshot['deadlines'].items():
+                self.call_timers.schedule(call, reason, deadline + offset)
+            if call.media_target is not None:
+                self.start_media(call, snapshot)
+            resumed += 1
+        if self.cluster:
+            self.cluster.publish_calls(len(self.active_calls))
+        try:
+            journal.start([self.call_snapshot(call) for call in self.active_calls.values()])
+        except OSError as e:
+            self.log(f"Call journal disabled: {e}", logging.ERROR)
+            self.journal = None
+            return
+        if snapshots:
+            self.log(f"Resumed {resumed} held calls from {path} ({expired} expired, "
+                     f"{len(snapshots) - resumed - expired} ended) in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    def handle_invite(self, transaction, addr, request):
         """Handle SIP INVITE request"""
         self.log(f"Handling INVITE from {addr[0]}:{addr[1]}")
 
+        existing = self.active_calls.get(transaction.call_id)
+        if existing is not None:
+            self.handle_reinvite(transaction, addr, request, existing)
+            return
+
+        # Shed new calls first, before any parsing or allocation; re-INVITEs above are always served
+        calls = len(self.port_pool)
+        if self.cluster:
+            calls += self.cluster.total_calls() - self.cluster.calls[self.cluster.index]
+        limit = self.admission.check(calls)
+        if limit is not None:
+            # Constant text so the repeat filter collapses a rejection storm into one line
+            self.log(f"Over the {limit} limit - rejecting new calls with 503", logging.WARNING)
+            self.metrics.inc('moh_admission_rejected_total', f'reason="{limit}"')
+            busy_response = self.create_sip_response(request, 503, "Service Unavailable",
+                                                     extra_headers=[self.admission.retry_after_header()])
+            self.send_response(transaction, addr, busy_response)
+            return
+
+        # Negotiate media and session timer before committing any resources
+        call = Call(transaction.call_id, None, addr)
+        call.playlist = self.select_playlist(request)
+        body = request.body.decode('utf-8', 'replace')
+        if body.strip():
+            offer = parse_sdp(body)
+            media = offer.audio()
+            codec = select_codec(media, self.codecs) if media and media.port else None
+            if codec is None:
+                self.log("No acceptable audio codec offered - rejecting call")
+                reject_response = self.create_sip_response(request, 488, "Not Acceptable Here")
+                self.send_response(transaction, addr, reject_response)
+                return
+            call.payload_type, call.encoding = codec
+            call.offer = offer
+            call.media_target = media_target(offer, media, addr)
+            call.rtcp_port = media.rtcp_port
+            if offer.media_direction(media) in ('sendonly', 'inactive'):
+                call.direction = 'inactive'
+
+        timer_headers = self.negotiate_session_timer(request, call)
+        if timer_headers is None:
+            self.log(f"Session-Expires below {self.min_se}s - rejecting call")
+            reject_response = self.create_sip_response(request, 422, "Session Interval Too Small",
+                                                       extra_headers=[f"Min-SE: {self.min_se}"])
+            self.send_response(transaction, addr, reject_response)
+            return
+
+        # Reserve the RTP port up front so an exhausted pool is rejected immediately
+        rtp_port = self.port_pool.allocate()
+        if rtp_port is None:
+            self.log(f"RTP port pool exhausted ({self.port_pool.size} ports in use) - rejecting call", logging.WARNING)
+            busy_response = self.create_sip_response(request, 503, "Service Unavailable",
+                                                     extra_headers=[self.admission.retry_after_header()])
+            self.send_response(transaction, addr, busy_response)
+            return
+        call.rtp_port = rtp_port
+        transaction.call = call
+
+        # One To-tag for every response in this dialog, including retransmissions
+        transaction.to_tag = self.generate_tag()
+
+        # Remember the dialog so we can send our own BYE later
+        call.sock = transaction.sock
+        call.local_address = request.advertised
+        if isinstance(call.sock, StreamConnections):
+            call.transport = call.sock.name
+        to_value = request.get('to') or ''
+        call.local_party = to_value if 'tag=' in to_value else f"{to_value};tag={transaction.to_tag}"
+        call.remote_party = request.get('from')
+        call.remote_target = header_uri(request.get('contact')) or header_uri(call.remote_party)
+        call.route_set = request.get_all('record-route')
+
         # Send 180 Ringing
-        ringing_response = self.create_sip_response(request_lines, 180, "Ringing")
-        self.send_response(sock, addr, ringing_response)
+        ringing_response = self.create_sip_response(request, 180, "Ringing", transaction.to_tag)
+        self.send_response(transaction, addr, ringing_response)
 
-        # Wait a moment before answering
-        time.sleep(1)
+        # Answer after a moment without holding up the event loop
+        transaction.schedule(self.answer_delay, self.answer_invite, transaction, addr, request, timer_headers)
 
-        # Generate RTP port
-        rtp_port = random.randint(10000, 10100)
+    def answer_invite(self, transaction, addr, request, timer_headers=()):
+        """Send 200 OK for a ringing INVITE and start Music On Hold"""
+        call = transaction.call
 
-        # Send 200 OK with SDP
-        ok_response = self.create_sip_ok_with_sdp(request_lines, rtp_port)
-        self.send_response(sock, addr, ok_response)
+        # Send 200 OK with SDP (an answer, or our offer of every enabled codec if the INVITE had none)
+        if call.media_target is None:
+            formats = [(CODECS[name].payload_type, name) for name in self.codecs]
+        else:
+            formats = [(call.payload_type, call.encoding)]
+        call.answer_sdp = build_sdp(call.local_address or self.host, call.rtp_port, formats, call.direction,
+                                    offer=call.offer)
+        call.offer = None
+        ok_response = self.create_sip_ok_with_sdp(request, call.answer_sdp, transaction.to_tag, timer_headers)
+        self.send_response(transaction, addr, ok_response)
 
-        # Extract Call-ID for tracking
-        call_id = None
-        for line in request_lines:
-            if line.startswith('Call-ID:'):
-                call_id = line.split(':', 1)[1].strip()
-                break
+        if not call.call_id:
+            self.port_pool.release(call.rtp_port)
+            return
+        self.active_calls[call.call_id] = call
+        if self.cluster:
+            self.cluster.publish_calls(len(self.active_calls))
+        self.refresh_session(call)
+        if self.max_call_duration:
+            self.call_timers.schedule(call, 'maximum hold duration reached',
+                                      time.monotonic() + self.max_call_duration)
+
+        if call.media_target is None:
+            self.log(f"INVITE without SDP offer - waiting for answer in ACK for call {call.call_id}")
+        else:
+            self.start_media(call)
+        self.journal_call(call)
+
+    def handle_reinvite(self, transaction, addr, request, call):
+        """Answer an in-dialog re-INVITE: session refresh and/or new media address"""
+        self.log(f"Handling re-INVITE for call {call.call_id}")
+        timer_headers = self.negotiate_session_timer(request, call)
+        if timer_headers is None:
+            reject_response = self.create_sip_response(request, 422, "Session Interval Too Small",
+                                                       extra_headers=[f"Min-SE: {self.min_se}"])
+            self.send_response(transaction, addr, reject_response)
+            return
+
+        body = request.body.decode('utf-8', 'replace')
+        offer = parse_sdp(body) if body.strip() else None
+        media = offer.audio() if offer else None
+        if media and media.port:
+            target = media_target(offer, media, addr)
+            if target != call.media_target:
+                self.log(f"Media for call {call.call_id} moved to {target[0]}:{target[1]}")
+                call.media_target = target
+                call.rtcp_port = media.rtcp_port
+                if call.stream and call.stream.sock.family != address_family(target[0]):
+                    # Moved between IPv4 and IPv6; a socket cannot change family, so start a new stream
+                    self.stop_rtp_stream(call)
+                    call.stream = None
+                if call.stream:
+                    call.stream.set_target(target)
+                    if call.rtcp:
+                        call.rtcp.target = self.rtcp_target(call)
+                elif call.answer_sdp:
+                    self.start_media(call)
+        if media and call.answer_sdp:
+            # The answer mirrors this offer's m= lines; a changed body needs a new o= version
+            origin = call.answer_sdp.split('\r\n', 2)[1].split()
+            session_id, version = int(origin[1]), int(origin[2])
+            formats = [(call.payload_type, call.encoding)]
+            address = call.local_address or self.host
+            answer_sdp = build_sdp(address, call.rtp_port, formats, call.direction, session_id, offer, version)
+            if answer_sdp != call.answer_sdp:
+                call.answer_sdp = build_sdp(address, call.rtp_port, formats, call.direction, session_id, offer,
+                                            version + 1)
 
-        if call_id and os.path.exists(self.audio_file):
-            # Start RTP stream
-            rtp_process = self.start_rtp_stream(addr[0], rtp_port, self.audio_file)
-            if rtp_process:
-                self.active_calls[call_id] = rtp_process
-                self.log(f"Started Music On Hold for call {call_id}")
+        ok_response = self.create_sip_ok_with_sdp(request, call.answer_sdp or '', extra_headers=timer_headers)
+        self.send_response(transaction, addr, ok_response)
+        self.refresh_session(call)
+        self.journal_call(call)
 
-    def handle_bye(self, sock, addr, request_lines):
+    def handle_update(self, transaction, addr, request):
+        """Answer an in-dialog UPDATE, used by RFC 4028 refreshers"""
+        call = self.active_calls.get(transaction.call_id)
+        if call is None:
+            self.send_response(transaction, addr, self.create_sip_response(
+                request, 481, "Call/Transaction Does Not Exist"))
+            return
+        timer_headers = self.negotiate_session_timer(request, call)
+        if timer_headers is None:
+            reject_response = self.create_sip_response(request, 422, "Session Interval Too Small",
+                                                       extra_headers=[f"Min-SE: {self.min_se}"])
+            self.send_response(transaction, addr, reject_response)
+            return
+        self.send_response(transaction, addr, self.create_sip_response(
+            request, 200, "OK", extra_headers=timer_headers))
+        self.refresh_session(call)
+        self.journal_call(call)
+
+    def handle_ack(self, transaction, addr, request):
+        """Complete a late-offer call from the SDP answer carried in the ACK"""
+        call = transaction.call
+        if call is None or call.media_target is not None or self.active_calls.get(call.call_id) is not call:
+            return
+        body = request.body.decode('utf-8', 'replace')
+        answer = parse_sdp(body) if body.strip() else None
+        media = answer.audio() if answer else None
+        codec = select_codec(media, self.codecs) if media and media.port else None
+        if codec is None:
+            self.log(f"ACK carried no usable SDP answer for call {call.call_id} - no audio")
+            return
+        call.payload_type, call.encoding = codec
+        call.media_target = media_target(answer, media, addr)
+        call.rtcp_port = media.rtcp_port
+        if answer.media_direction(media) in ('sendonly', 'inactive'):
+            call.direction = 'inactive'
+        self.start_media(call)
+        self.journal_call(call)
+
+    def handle_transaction_timeout(self, transaction):
+        """Timer H fired: the caller never ACKed our final response"""
+        call = self.active_calls.get(transaction.call_id)
+        self.log(f"No ACK received for call {transaction.call_id} - giving up", logging.WARNING)
+        if call is not None:
+            # The dialog exists (an unACKed 2xx, or a re-INVITE answered with an error),
+            # so the caller is told with a BYE like any other teardown
+            self.hangup(call, "no ACK received")
+
+    def handle_bye(self, transaction, addr, request):
         """Handle SIP BYE request"""
         self.log(f"Handling BYE from {addr[0]}:{addr[1]}")
 
         # Send 200 OK
-        ok_response = self.create_sip_response(request_lines, 200, "OK")
-        self.send_response(sock, addr, ok_response)
+        ok_response = self.create_sip_response(request, 200, "OK")
+        self.send_response(transaction, addr, ok_response)
 
         # Stop RTP stream
-        call_id = None
-        for line in request_lines:
-            if line.startswith('Call-ID:'):
-                call_id = line.split(':', 1)[1].strip()
-                break
+        call_id = transaction.call_id
+        self.transactions.end_dialog(call_id)
 
-        if call_id in self.active_calls:
-            try:
-                self.active_calls[call_id].terminate()
-                del self.active_calls[call_id]
+        try:
+            if self.end_call(call_id):
                 self.log(f"Stopped Music On Hold for call {call_id}")
-            except Exception as e:
-                self.log(f"Error stopping RTP stream: {e}")
+        except Exception as e:
+            self.log(f"Error stopping RTP stream: {e}", logging.ERROR)
 
-    def handle_request(self, sock, addr, data):
+    def handle_request(self, sock, addr, data, local=None):
         """Handle incoming SIP request"""
         try:
-            request = data.decode('utf-8')
-            request_lines = request.split('\r\n')
+            if data.startswith((b'OPTIONS ', b'REGISTER ')):
+                # Keepalive fast path: stateless 200 OK from the precompiled template,
+                # straight from the bytes; anything unusual goes through the parser below
+                method = 'OPTIONS' if data[0] == 0x4F else 'REGISTER'
+                transport = sock.name if isinstance(sock, StreamConnections) else 'UDP'
+                response = self.templates.answer(data, 200, self.advertised_address(local, addr[0]), transport)
+                if response is not None:
+                    self.metrics.inc('moh_sip_requests_total', f'method="{method}"')
+                    self.log(f"Received {method} from {addr[0]}:{addr[1]}", logging.DEBUG)
+                    self.send_response(sock, addr, response)
+                    return
+
+            request = SIPMessage(data)
+            if not request.start_line:
+                return
+
+            method = request.method
+            # Worker mode listens on UDP only (stream connections could not be handed over)
+            if self.cluster and method not in ('REGISTER', 'OPTIONS') and not isinstance(sock, StreamConnections):
+                owner = self.cluster.owner(request.get('call-id') or '')
+                if owner != self.cluster.index:
+                    self.cluster.forward(owner, addr, data, local)
+                    return
+            if request.is_response:
+                self.handle_response(addr, request)
+                return
+            request.advertised = self.advertised_address(local, addr[0])
+            if isinstance(sock, StreamConnections):
+                request.transport = sock.name
 
-            if not request_lines:
+            self.metrics.inc('moh_sip_requests_total',
+                             f'method="{method if method in METRIC_METHODS else "other"}"')
+            self.log(f"Received {method} from {addr[0]}:{addr[1]}", logging.DEBUG)
+
+            if method in ('REGISTER', 'OPTIONS'):
+                # Keepalive fast path: stateless 200 OK from the precompiled template
+                self.send_response(sock, addr, self.templates.render(request, 200))
+                return
+
+            key = transaction_key(request)
+            if method == 'ACK':
+                # ACK is fire-and-forget; it stops 200 OK retransmission
+                transaction = self.transactions.ack(key)
+                if transaction:
+                    self.log(f"ACK received for call {key[1]}", logging.DEBUG)
+                    self.handle_ack(transaction, addr, request)
+                else:
+                    self.log("ACK received - no matching transaction", logging.DEBUG)
                 return
 
-            method = request_lines[0].split()[0]
-            self.log(f"Received {method} from {addr[0]}:{addr[1]}")
+            transaction = self.transactions.get(key)
+            if transaction:
+                # Retransmission: answer from the cached response, never re-run the handler
+                self.log(f"Retransmitted {method} from {addr[0]}:{addr[1]} - replaying last response", logging.DEBUG)
+                transaction.retransmit()
+                return
+            transaction = self.transactions.create(key, sock, addr)
 
             if method == 'INVITE':
-                self.handle_invite(sock, addr, request_lines)
+                self.handle_invite(transaction, addr, request)
             elif method == 'BYE':
-                self.handle_bye(sock, addr, request_lines)
-            elif method == 'ACK':
-                # ACK is fire-and-forget, no response needed
-                self.log("ACK received - no response needed")
-            elif method in ['REGISTER', 'OPTIONS']:
-                # Send 200 OK for REGISTER/OPTIONS
-                ok_response = self.create_sip_response(request_lines, 200, "OK")
-                self.send_response(sock, addr, ok_response)
+                self.handle_bye(transaction, addr, request)
+            elif method == 'UPDATE':
+                self.handle_update(transaction, addr, request)
             else:
                 # Send 501 Not Implemented for other methods
-                not_impl_response = self.create_sip_response(request_lines, 501, "Not Implemented")
-                self.send_response(sock, addr, not_impl_response)
+                self.send_response(transaction, addr, self.templates.render(request, 501))
 
         except Exception as e:
-            self.log(f"Error handling request: {e}")
+            self.log(f"Error handling request: {e}", logging.ERROR)
 
-    def start_server(self):
-        """Start the SIP server"""
-        sock = None
+    def datagram_received(self, sock, data, addr, local=None):
+        """Entry point for every UDP datagram or framed TCP/TLS message, called on the event loop
+
+        local is the address the message was sent to, when the transport could tell.
+        """
+        self.packet_count += 1
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # Packet dumps are only formatted when someone is going to read them
+            self.log(f"*** PACKET #{self.packet_count} RECEIVED from {addr[0]}:{addr[1]} ***", logging.DEBUG)
+            self.log(f"Data length: {len(data)} bytes", logging.DEBUG)
+            self.log(f"Raw data preview: {data[:100]}...", logging.DEBUG)
+
+        # Handlers never block, so they run inline instead of on a thread per packet
+        self._received_at = time.perf_counter()
         try:
-            self.log(f"Starting SIP server on {self.host}:{self.port}")
-            self.log(f"Audio file: {self.audio_file}")
+            self.handle_request(sock, addr, data, local)
+        finally:
+            self._received_at = None
 
-            self.log("Creating UDP socket...")
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    async def handle_metrics_client(self, reader, writer):
+        """Minimal HTTP/1.0 responder for GET /metrics"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5.0)
+            while (await asyncio.wait_for(reader.readline(), 5.0)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?', 1)[0] == b'/metrics':
+                status, body = "200 OK", self.metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.0 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
 
-            # Enable socket reuse
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    def stop(self):
+        """Request a clean shutdown of a running server (thread-safe)"""
+        if self.loop and self._shutdown:
+            self.loop.call_soon_threadsafe(self._shutdown.set)
 
-            self.log(f"Binding to {self.host}:{self.port}...")
-            sock.bind((self.host, self.port))
+    async def serve(self):
+        """Run the signalling event loop until shutdown is requested"""
+        self.loop = asyncio.get_running_loop()
+        self._shutdown = asyncio.Event()
+        self.transactions = TransactionTable(self.loop, on_timeout=self.handle_transaction_timeout)
 
-            # Set a timeout to help with debugging
-            sock.settimeout(1.0)
+        # Bounded pool for blocking work (audio decoding, file I/O) off the event loop
+        self.loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='moh-worker'))
 
-            self.log("SIP server started - waiting for connections...")
-            self.log("Server is ready to receive SIP messages")
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self.loop.add_signal_handler(sig, self._shutdown.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not on the main thread or not supported on this platform
+                pass
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                self.loop.add_signal_handler(signal.SIGHUP, self.request_reload)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass
 
-            packet_count = 0
-            while True:
+        metrics_server = None
+        stream_servers = []
+        try:
+            hosts = ('0.0.0.0', '::') if self.host in ('', '::') else (self.host,)
+            for host in hosts:
+                self.log(f"Binding to {uri_host(host)}:{self.port}...", logging.DEBUG)
                 try:
-                    data, addr = sock.recvfrom(4096)
-                    packet_count += 1
-                    self.log(f"*** PACKET #{packet_count} RECEIVED from {addr[0]}:{addr[1]} ***")
-                    self.log(f"Data length: {len(data)} bytes")
-                    self.log(f"Raw data preview: {data[:100]}...")
-
-                    # Handle each request in a separate thread
-                    thread = threading.Thread(target=self.handle_request, args=(sock, addr, data))
-                    thread.daemon = True
-                    thread.start()
-
-                except socket.timeout:
-                    # This is normal - just continue waiting
-                    continue
-                except Exception as e:
-                    self.log(f"ERROR in packet reception: {e}")
+                    sock = self.open_udp_socket(host)
+                except OSError as e:
+                    if host != '::' or len(hosts) == 1:
+                        raise
+                    # Kernel or container without IPv6: carry on with IPv4 only
+                    self.log(f"Not listening on IPv6: {e}", logging.WARNING)
                     continue
+                self.udp_sockets[sock.family] = sock
+                self.listen_addresses.append(host)
+                listener = UDPListener(self, sock)
+                if not listener.pktinfo:
+                    self.log(f"No IP_PKTINFO on {uri_host(host)} - advertising addresses from the routing table",
+                             logging.WARNING)
+                self.loop.add_reader(sock.fileno(), listener.read)
+            self.log(f"Listening for SIP over UDP on {self.listen_description(self.port)}")
+            if self.cluster:
+                channel = self.cluster.channels[self.cluster.index][0]
+                channel.setblocking(False)
+                await self.loop.create_datagram_endpoint(lambda: ForwardProtocol(self), sock=channel)
+            if self.tcp_port:
+                stream_servers.append(await self.start_stream_listener('TCP', self.tcp_port))
+            if self.tls_port and self.tls_cert:
+                try:
+                    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                    context.load_cert_chain(self.tls_cert, self.tls_key)
+                except (OSError, ssl.SSLError) as e:
+                    self.log(f"SIP over TLS disabled: {e}", logging.WARNING)
+                else:
+                    stream_servers.append(await self.start_stream_listener('TLS', self.tls_port, context))
+            if self.metrics_port:
+                try:
+                    metrics_server = await asyncio.start_server(
+                        self.handle_metrics_client, self.metrics_host, self.metrics_port)
+                    self.log(f"Metrics available at http://{self.metrics_host}:{self.metrics_port}/metrics")
+                except OSError as e:
+                    self.log(f"Metrics endpoint disabled: {e}", logging.WARNING)
+
+            await self.loop.run_in_executor(None, self.load_audio)
+            if self.journal_file:
+                self.resume_calls()
+            self.loop.call_later(self.reaper_interval, self.reap_calls)
+            if self.watch_interval:
+                self._watch_state = self._watch_pending = self.watched_file_state()
+                self.loop.call_later(self.watch_interval, self.check_for_changes)
+
+            self.log("SIP server started - waiting for connections...")
+            self.log("Server is ready to receive SIP messages")
+            await self._shutdown.wait()
+            self.log("Shutting down server...")
+        finally:
+            if metrics_server:
+                metrics_server.close()
+            for server in stream_servers:
+                if server is not None:
+                    server.close()
+            for connections in self.stream_connections.values():
+                connections.close()
+            for sock in self.udp_sockets.values():
+                self.loop.remove_reader(sock.fileno())
+                sock.close()
+            self.log("Socket closed")
+
+    def listen_description(self, port):
+        return ', '.join(f"{uri_host(host)}:{port}" for host in self.listen_addresses)
+
+    def open_udp_socket(self, host):
+        """Non-blocking UDP socket bound to the SIP port on one address"""
+        family = address_family(host)
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.cluster:
+                # Every worker binds the same port; the kernel load-balances between them
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if family == socket.AF_INET6:
+                # IPv4 has its own socket, so peers never show up as ::ffff: mapped addresses
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER)
+            sock.setblocking(False)
+            sock.bind((host, self.port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    async def start_stream_listener(self, name, port, ssl_context=None):
+        """Listen for SIP over TCP or TLS; returns the server, or None if the port is unavailable"""
+        connections = StreamConnections(name)
+        try:
+            server = await self.loop.create_server(
+                lambda: SIPStreamProtocol(self, connections), self.listen_addresses, port,
+                ssl=ssl_context, reuse_port=bool(self.cluster))
+        except OSError as e:
+            self.log(f"SIP over {name} disabled: {e}", logging.WARNING)
+            return None
+        self.stream_connections[name] = connections
+        self.log(f"Listening for SIP over {name} on {self.listen_description(port)}")
+        return server
+
+    def run_worker(self, cluster, index):
+        """Entry point of a forked worker process"""
+        cluster.index = index
+        self.cluster = cluster
+        self.logger = setup_logging(self.log_level, self.log_format)
+        self.port_pool = RTPPortPool(*cluster.port_range(*self.rtp_port_range))
+        if self.metrics_port:
+            self.metrics_port += index
+        self.log(f"Worker {index} started (pid {os.getpid()}, RTP ports "
+                 f"{self.port_pool.start}-{self.port_pool.end - 1})")
+        self.start_server()
+
+    def run_workers(self):
+        """Fork one worker per core, all serving the SIP port through SO_REUSEPORT"""
+        cluster = ClusterState(self.workers)
+        context = multiprocessing.get_context('fork')
+        processes = {}
+        stopping = []
+
+        def spawn(index):
+            cluster.calls[index] = 0
+            process = context.Process(target=self.run_worker, args=(cluster, index),
+                                      name=f"moh-worker-{index}", daemon=True)
+            process.start()
+            processes[index] = process
+
+        def shutdown(signum, frame):
+            stopping.append(signum)
+            for process in processes.values():
+                if process.is_alive():
+                    process.terminate()
+
+        self.log(f"Starting {self.workers} worker processes on {uri_host(self.host)}:{self.port}")
+        flush_logging()
+        for index in range(self.workers):
+            spawn(index)
+
+        def reload(signum, frame):
+            for process in processes.values():
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGHUP)
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGHUP, reload)
+
+        while processes:
+            sentinels = {process.sentinel: index for index, process in processes.items()}
+            for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                index = sentinels[sentinel]
+                exitcode = processes.pop(index).exitcode
+                if not stopping:
+                    self.log(f"Worker {index} exited with code {exitcode} - restarting", logging.ERROR)
+                    spawn(index)
+        self.log("All workers stopped")
+        flush_logging()
+
+    def start_server(self):
+        """Start the SIP server"""
+        if self.workers > 1 and self.cluster is None:
+            return self.run_workers()
+        try:
+            self.log(f"Starting SIP server on {uri_host(self.host)}:{self.port}")
+            self.log(f"Audio file: {self.audio_file}")
+            asyncio.run(self.serve())
 
         except Exception as e:
-            self.log(f"FATAL ERROR in start_server: {e}")
+            self.log(f"FATAL ERROR in start_server: {e}", logging.CRITICAL)
             import traceback
-            self.log(f"Traceback: {traceback.format_exc()}")
+            self.log(f"Traceback: {traceback.format_exc()}", logging.CRITICAL)
             raise
         except KeyboardInterrupt:
             self.log("Shutting down server...")
         finally:
+            # Calls torn down by a shutdown stay in the journal, so a restart picks them up again
+            if self.journal:
+                self.journal.close()
             # Clean up active calls
-            for call_id, process in self.active_calls.items():
+            for call_id in list(self.active_calls):
                 try:
-                    process.terminate()
+                    self.end_call(call_id, shutdown=True)
                 except:
                     pass
-            if sock:
-                sock.close()
-                self.log("Socket closed")
+            for name in list(self.queues):
+                self.close_playlist(name)
+            flush_logging()
 
 if __name__ == '__main__':
-    server = SimpleSIPServer()
+    server = SimpleSIPServer(host=os.environ.get('MOH_HOST') or '::',
+                             advertise_address=os.environ.get('MOH_ADVERTISE_ADDRESS') or None,
+                             audio_file=os.environ.get('MOH_AUDIO_FILE') or '/app/sounds/music.wav',
+                             cache_dir=os.environ.get('MOH_CACHE_DIR') or None,
+                             log_level=os.environ.get('MOH_LOG_LEVEL', 'INFO'),
+                             log_format=os.environ.get('MOH_LOG_FORMAT', 'text'),
+                             workers=int(os.environ.get('MOH_WORKERS', '1')),
+                             playlist_file=os.environ.get('MOH_PLAYLISTS') or None,
+                             max_calls=int(os.environ.get('MOH_MAX_CALLS', '0')),
+                             max_cpu=float(os.environ.get('MOH_MAX_CPU', '0.9')),
+                             max_bandwidth=int(os.environ.get('MOH_MAX_BANDWIDTH', '0')),
+                             tcp_port=int(os.environ['MOH_TCP_PORT']) if os.environ.get('MOH_TCP_PORT') else None,
+                             tls_port=int(os.environ['MOH_TLS_PORT']) if os.environ.get('MOH_TLS_PORT') else None,
+                             tls_cert=os.environ.get('MOH_TLS_CERT') or None,
+                             tls_key=os.environ.get('MOH_TLS_KEY') or None,
+                             journal_file=os.environ.get('MOH_JOURNAL') or None,
+                             codecs=tuple(name.strip().upper()
+                                          for name in os.environ.get('MOH_CODECS', 'PCMU,PCMA').split(',')
+                                          if name.strip()))
     server.start_server()
\ No newline at end of file
@@ -4,19 +4,14 @@ set -e
 
 echo "Music On Hold Server Starting..."
 
-# Convert MP3 to WAV format suitable for RTP streaming
+# The server decodes the MP3 itself and keeps the encoded frames in a cache, so
+# calls are answered as soon as the first seconds are ready and later starts skip decoding
 if [ -f "/music.mp3" ]; then
-    echo "Converting MP3 to WAV format (8kHz, mono, PCM)..."
-    ffmpeg -i /music.mp3 -ar 8000 -ac 1 -c:a pcm_s16le -f wav /app/sounds/music.wav -y
-
-    if [ $? -eq 0 ]; then
-        echo "Audio conversion completed successfully"
-        ls -la /app/sounds/
-        echo "Audio file info:"
-        ffprobe /app/sounds/music.wav 2>&1 | grep -E "(Duration|Stream|Audio)" || true
-    else
-        echo "Error: Audio conversion failed"
-        exit 1
+    export MOH_AUDIO_FILE="${MOH_AUDIO_FILE:-/music.mp3}"
+    export MOH_CACHE_DIR="${MOH_CACHE_DIR:-/app/sounds/cache}"
+    echo "Audio file: $MOH_AUDIO_FILE (encoded frames cached in $MOH_CACHE_DIR)"
+    if ! command -v ffmpeg > /dev/null; then
+        echo "Warning: ffmpeg not found - only WAV files can be played"
     fi
 else
     echo "Error: No music file found at /music.mp3"
@@ -26,4 +21,4 @@ fi
 
 echo "Starting lightweight SIP server..."
 cd /app
-exec python3 sip_server.py
\ No newline at end of file
+exec python3 sip_server.py
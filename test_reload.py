@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Reload test: a playlist file that fails to load is tried once, not on every poll
+"""
+
+import asyncio
+import json
+import wave
+
+import sip_server
+
+
+def write_wav(path, seconds=1):
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(b'\x00\x00' * 8000 * seconds)
+
+
+def test_bad_playlist_file_reloads_once(tmp_path):
+    audio = tmp_path / 'music.wav'
+    playlist_file = tmp_path / 'playlists.json'
+    write_wav(audio)
+    playlist_file.write_text(json.dumps({'playlists': {'100': [str(audio)]}}))
+    server = sip_server.SimpleSIPServer(audio_file=str(audio), cache_dir=str(tmp_path / 'cache'),
+                                        playlist_file=str(playlist_file), codecs=('PCMU',),
+                                        watch_interval=0.05, log_level='CRITICAL')
+    attempts = []
+    reload = server.reload
+
+    async def counted_reload():
+        attempts.append(playlist_file.read_text())
+        await reload()
+
+    server.reload = counted_reload
+
+    async def run():
+        server.loop = asyncio.get_running_loop()
+        server._watch_state = server._watch_pending = server.watched_file_state()
+        server.check_for_changes()
+        playlist_file.write_text(json.dumps({'playlists': {'100': [str(audio)]}, 'no_such_setting': 1}))
+        await asyncio.sleep(1.0)
+
+    asyncio.run(run())
+    assert len(attempts) == 1
+    assert server.playlists['100'] == [str(audio)]
+
+
+if __name__ == '__main__':
+    import tempfile
+    import pathlib
+    with tempfile.TemporaryDirectory() as directory:
+        test_bad_playlist_file_reloads_once(pathlib.Path(directory))
+    print("✓ A bad playlist file triggers exactly one reload attempt")
@@ -11,35 +11,55 @@ import threading
 from datetime import datetime
 
 class SimpleSIPClient:
-    def __init__(self, server_host='192.168.52.3', server_port=5060, local_port=5061):
+    def __init__(self, server_host='127.0.0.1', server_port=5060, local_port=5061, local_ip=None):
         self.server_host = server_host
         self.server_port = server_port
         self.local_port = local_port
+        # Skips the route lookup in get_local_ip(), e.g. for loopback load tests
+        self.local_ip = local_ip
         self.call_id = None
         self.branch = None
         self.tag = None
+        self.target_number = "123"
         self.socket = None
 
     def log(self, message):
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         print(f"[{timestamp}] CLIENT: {message}")
 
+    # 64 random bits: six digits collide within a few thousand concurrent load-test calls
     def generate_call_id(self):
-        return f"{random.randint(100000, 999999)}@test-client"
+        return f"{random.getrandbits(64):016x}@test-client"
 
     def generate_branch(self):
-        return f"z9hG4bK{random.randint(100000, 999999)}"
+        return f"z9hG4bK{random.getrandbits(64):016x}"
 
     def generate_tag(self):
-        return f"tag-{random.randint(10000, 99999)}"
+        return f"tag-{random.getrandbits(32):08x}"
 
-    def create_invite(self, target_number="123"):
+    def create_sdp(self, rtp_port=12000, payload_type=0, encoding="PCMU"):
+        """Create the SDP offer for an INVITE"""
+        local_ip = self.get_local_ip()
+
+        sdp = f"""v=0
+o=testclient 123456 123456 IN IP4 {local_ip}
+s=Test Call
+c=IN IP4 {local_ip}
+t=0 0
+m=audio {rtp_port} RTP/AVP {payload_type}
+a=rtpmap:{payload_type} {encoding}/8000
+"""
+        return sdp.replace('\n', '\r\n')
+
+    def create_invite(self, target_number="123", rtp_port=12000, payload_type=0, encoding="PCMU"):
         """Create SIP INVITE message"""
         self.call_id = self.generate_call_id()
         self.branch = self.generate_branch()
         self.tag = self.generate_tag()
+        self.target_number = target_number
 
         local_ip = self.get_local_ip()
+        sdp = self.create_sdp(rtp_port, payload_type, encoding)
 
         invite = f"""INVITE sip:{target_number}@{self.server_host}:{self.server_port} SIP/2.0
 Via: SIP/2.0/UDP {local_ip}:{self.local_port};branch={self.branch}
@@ -49,19 +69,11 @@ Call-ID: {self.call_id}
 CSeq: 1 INVITE
 Contact: <sip:testclient@{local_ip}:{self.local_port}>
 Content-Type: application/sdp
-Content-Length: 142
+Content-Length: {len(sdp)}
 User-Agent: TestSIPClient/1.0
 
-v=0
-o=testclient 123456 123456 IN IP4 {local_ip}
-s=Test Call
-c=IN IP4 {local_ip}
-t=0 0
-m=audio 12000 RTP/AVP 0
-a=rtpmap:0 PCMU/8000
-
 """
-        return invite.replace('\n', '\r\n')
+        return invite.replace('\n', '\r\n') + sdp
 
     def create_ack(self, response_lines):
         """Create SIP ACK message"""
@@ -74,7 +86,7 @@ a=rtpmap:0 PCMU/8000
                 to_header = line
                 break
 
-        ack = f"""ACK sip:123@{self.server_host}:{self.server_port} SIP/2.0
+        ack = f"""ACK sip:{self.target_number}@{self.server_host}:{self.server_port} SIP/2.0
 Via: SIP/2.0/UDP {local_ip}:{self.local_port};branch={self.branch}
 From: <sip:testclient@{local_ip}:{self.local_port}>;tag={self.tag}
 {to_header}
@@ -96,7 +108,7 @@ Content-Length: 0
                 to_header = line
                 break
 
-        bye = f"""BYE sip:123@{self.server_host}:{self.server_port} SIP/2.0
+        bye = f"""BYE sip:{self.target_number}@{self.server_host}:{self.server_port} SIP/2.0
 Via: SIP/2.0/UDP {local_ip}:{self.local_port};branch={self.generate_branch()}
 From: <sip:testclient@{local_ip}:{self.local_port}>;tag={self.tag}
 {to_header}
@@ -107,8 +119,26 @@ Content-Length: 0
 """
         return bye.replace('\n', '\r\n')
 
+    def create_options(self):
+        """Create SIP OPTIONS message"""
+        local_ip = self.get_local_ip()
+
+        options = f"""OPTIONS sip:{self.server_host}:{self.server_port} SIP/2.0
+Via: SIP/2.0/UDP {local_ip}:{self.local_port};branch={self.generate_branch()}
+From: <sip:testclient@{local_ip}:{self.local_port}>;tag={self.generate_tag()}
+To: <sip:{self.server_host}:{self.server_port}>
+Call-ID: {self.generate_call_id()}
+CSeq: 1 OPTIONS
+Content-Length: 0
+User-Agent: TestSIPClient/1.0
+
+"""
+        return options.replace('\n', '\r\n')
+
     def get_local_ip(self):
         """Get local IP address"""
+        if self.local_ip:
+            return self.local_ip
         try:
             # Connect to a remote address to determine local IP
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -152,21 +182,7 @@ Content-Length: 0
         """Test SIP OPTIONS method"""
         self.log("Testing SIP OPTIONS...")
 
-        local_ip = self.get_local_ip()
-        call_id = self.generate_call_id()
-        branch = self.generate_branch()
-
-        options = f"""OPTIONS sip:{self.server_host}:{self.server_port} SIP/2.0
-Via: SIP/2.0/UDP {local_ip}:{self.local_port};branch={branch}
-From: <sip:testclient@{local_ip}:{self.local_port}>;tag={self.generate_tag()}
-To: <sip:{self.server_host}:{self.server_port}>
-Call-ID: {call_id}
-CSeq: 1 OPTIONS
-Content-Length: 0
-User-Agent: TestSIPClient/1.0
-
-"""
-        self.send_message(options.replace('\n', '\r\n'))
+        self.send_message(self.create_options())
         response = self.receive_response()
 
         if response and response[0].startswith('SIP/2.0 200'):